@@ -0,0 +1,112 @@
+"""Wall time and peak RSS of turning a fetched notebook into a saved clone
+
+Compares the old nbformat.reads/writes/json.loads round-trip in
+CloneHandler.clone_to_directory with the single parse of
+clonenotebooks.cloners.convert.notebook_content, both followed by
+FileContentsManager.save as in the cloner. Each measurement runs in a
+fresh process so peak RSS isn't shared between runs.
+
+Run it with clonenotebooks installed, e.g.
+
+    python benchmarks/bench_clone_convert.py --sizes 10 50 200
+"""
+
+import argparse
+import base64
+from datetime import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+import nbformat
+from notebook.services.contents.filemanager import FileContentsManager
+
+from clonenotebooks.cloners.convert import notebook_content
+
+
+def make_notebook(size_mb, cells=100):
+    """A v4 notebook of roughly size_mb megabytes, mostly embedded PNG outputs"""
+    per_cell = int(size_mb * 1024 * 1024 * 3 / 4 / cells)
+    png = base64.b64encode(os.urandom(per_cell)).decode("ascii")
+    nb = nbformat.v4.new_notebook()
+    for i in range(cells):
+        cell = nbformat.v4.new_code_cell("plot({})".format(i), execution_count=i + 1)
+        cell.outputs.append(
+            nbformat.v4.new_output("display_data", data={"image/png": png})
+        )
+        nb.cells.append(cell)
+    return nbformat.writes(nb)
+
+
+def convert_old(nb):
+    nbnode = nbformat.reads(nb, as_version=4)
+    nb = nbformat.writes(nbnode)
+    return json.loads(nb)
+
+
+def convert_new(nb):
+    return notebook_content(nb)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_one(path, size_mb):
+    nb = make_notebook(size_mb)
+    convert = convert_old if path == "old" else convert_new
+    with TemporaryDirectory() as root:
+        contents_manager = FileContentsManager(root_dir=root)
+        baseline = peak_rss_mb()
+        start = time.perf_counter()
+        now = datetime.now()
+        model = {
+            "content": convert(nb),
+            "created": now,
+            "format": "json",
+            "last_modified": now,
+            "mimetype": None,
+            "type": "notebook",
+            "writable": True,
+        }
+        contents_manager.save(model, "clone.ipynb")
+        elapsed = time.perf_counter() - start
+    print(json.dumps({"seconds": elapsed, "peak_rss_mb": peak_rss_mb() - baseline}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument(
+        "--run", nargs=2, metavar=("PATH", "SIZE_MB"), help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args.run[0], float(args.run[1]))
+        return
+
+    print(
+        "{:>8} {:>6} {:>10} {:>14}".format("size_mb", "path", "seconds", "peak_rss_mb")
+    )
+    for size_mb in args.sizes:
+        for path in ("old", "new"):
+            output = subprocess.check_output(
+                [sys.executable, __file__, "--run", path, str(size_mb)]
+            )
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print(
+                "{:>8} {:>6} {:>10.3f} {:>14.1f}".format(
+                    size_mb, path, result["seconds"], result["peak_rss_mb"]
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Wall time and bytes written for N users cloning the same notebook at once
+
+Compares saving every clone through FileContentsManager.save, as the cloner does
+by default, with making the clones from a clonenotebooks.cloners.dedup.DedupStore
+in each of its link modes. Every clone runs in its own process, like the clones of
+different users' servers would, and they all start together. "written" is the
+bytes each process passed to write() (wchar in /proc/self/io, so Linux only) and
+"disk" the space taken by the store and the clones, counting shared files once.
+
+Run it with clonenotebooks installed, e.g.
+
+    python benchmarks/bench_dedup_clone.py --users 10 100 --size 20 --dir /scratch/tmp
+
+--dir should be on the filesystem that would hold the store and home directories,
+since whether reflinks work depends on it.
+"""
+
+import argparse
+import base64
+from datetime import datetime
+import multiprocessing
+import os
+from tempfile import TemporaryDirectory
+import time
+
+import nbformat
+from notebook.services.contents.filemanager import FileContentsManager
+
+from clonenotebooks.cloners.convert import notebook_content
+from clonenotebooks.cloners.dedup import LINK_MODES, DedupStore
+
+MODES = ("save",) + LINK_MODES
+
+
+def make_notebook(size_mb, cells=100):
+    """A v4 notebook of roughly size_mb megabytes, mostly embedded PNG outputs"""
+    per_cell = int(size_mb * 1024 * 1024 * 3 / 4 / cells)
+    png = base64.b64encode(os.urandom(per_cell)).decode("ascii")
+    nb = nbformat.v4.new_notebook()
+    for i in range(cells):
+        cell = nbformat.v4.new_code_cell("plot({})".format(i), execution_count=i + 1)
+        cell.outputs.append(
+            nbformat.v4.new_output("display_data", data={"image/png": png})
+        )
+        nb.cells.append(cell)
+    return nbformat.writes(nb).encode("utf-8")
+
+
+def written_bytes():
+    with open("/proc/self/io") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name == "wchar":
+                return int(value)
+    return 0
+
+
+def clone_one(mode, data, store_dir, home, start, results):
+    start.wait()
+    before = written_bytes()
+    if mode == "save":
+        now = datetime.now()
+        model = {
+            "content": notebook_content(data),
+            "created": now,
+            "format": "json",
+            "last_modified": now,
+            "mimetype": None,
+            "type": "notebook",
+            "writable": True,
+        }
+        FileContentsManager(root_dir=home).save(model, "clone.ipynb")
+    else:
+        store = DedupStore(store_dir, mode)
+        digest = store.add(data)
+        store.clone(digest, os.path.join(home, "clone.ipynb"), data)
+    results.put(written_bytes() - before)
+
+
+def disk_bytes(root):
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            st = os.stat(os.path.join(dirpath, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+
+def run(mode, users, data, directory):
+    with TemporaryDirectory(dir=directory) as root:
+        store_dir = os.path.join(root, "store")
+        homes = [os.path.join(root, "home", str(i)) for i in range(users)]
+        for home in homes:
+            os.makedirs(home)
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=clone_one, args=(mode, data, store_dir, home, start, results)
+            )
+            for home in homes
+        ]
+        for process in processes:
+            process.start()
+        tic = time.perf_counter()
+        start.set()
+        written = sum(results.get() for _ in processes)
+        elapsed = time.perf_counter() - tic
+        for process in processes:
+            process.join()
+        return elapsed, written, disk_bytes(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--size", type=float, default=10, help="notebook size in MB")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--dir", default=None, help="where to create the clones")
+    args = parser.parse_args()
+
+    data = make_notebook(args.size)
+    print(
+        "{:>6} {:>9} {:>10} {:>12} {:>10}".format(
+            "users", "mode", "seconds", "written_mb", "disk_mb"
+        )
+    )
+    for users in args.users:
+        for mode in args.modes:
+            elapsed, written, disk = run(mode, users, data, args.dir)
+            print(
+                "{:>6} {:>9} {:>10.3f} {:>12.1f} {:>10.1f}".format(
+                    users, mode, elapsed, written / 2 ** 20, disk / 2 ** 20
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""Offline load test of the clone and render paths
+
+Starts, all on localhost:
+
+- an HTTP server with synthetic notebooks (and kernel.json files) of the given size,
+- a stand-in for the JupyterHub API that knows a single user, "bench",
+- a notebook server running the clonenotebooks.cloners extension on a temp root dir,
+- unless --no-nbviewer, nbviewer with the clonenotebooks renderers,
+
+then drives each scenario at the given concurrency and reports latency percentiles,
+throughput and the servers' peak RSS (Linux only), e.g.
+
+    python benchmarks/bench_load.py --requests 500 --concurrency 1 10 50 --size 5
+
+Scenarios:
+
+    url_clone     /url_clone on the notebook server
+    local_clone   /local_clone on the notebook server
+    render_clone  nbviewer's ?clone redirect for a local notebook
+    url_redirect  nbviewer's ?clone redirect for a notebook URL
+    render        nbviewer rendering a notebook from a URL
+
+The notebook server reaches the synthetic notebooks as http://nbhost/, which is resolved
+to the right port inside its process, so no DNS or privileged ports are needed.
+--json prints the results as JSON lines instead, to keep per-commit records.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+import nbformat
+from tornado import httpclient, web
+from tornado.httpserver import HTTPServer
+
+NOTEBOOK_HOST = "nbhost"
+USER = "bench"
+TOKEN = "bench-token"
+
+SCENARIOS = ("url_clone", "local_clone", "render_clone", "url_redirect", "render")
+# The ones that don't need nbviewer
+NOTEBOOK_SCENARIOS = ("url_clone", "local_clone")
+
+# Run in the notebook server's process before it starts, so that its HTTP clients
+# resolve NOTEBOOK_HOST to the local notebook server (only the simple client can)
+NOTEBOOK_BOOTSTRAP = """
+import sys
+from tornado.httpclient import AsyncHTTPClient
+from tornado.netutil import DefaultExecutorResolver, OverrideResolver
+from notebook.notebookapp import main
+
+port = int(sys.argv.pop(1))
+mapping = {{({host!r}, 80): ("127.0.0.1", port)}}
+AsyncHTTPClient.configure(
+    None, resolver=OverrideResolver(resolver=DefaultExecutorResolver(), mapping=mapping)
+)
+sys.exit(main())
+"""
+
+NBVIEWER_CONFIG = """
+c.NBViewer.handler_settings = {{"clone_notebooks": True, "clone_to_directory": "/"}}
+c.NBViewer.local_handler = "clonenotebooks.renderers.LocalRenderingHandler"
+c.NBViewer.url_handler = "clonenotebooks.renderers.URLRenderingHandler"
+c.NBViewer.localfiles = {localfiles!r}
+c.NBViewer.template_path = {templates!r}
+c.NBViewer.static_path = {static!r}
+"""
+
+
+def make_notebook(size_mb, cells):
+    """A v4 notebook of roughly size_mb megabytes, mostly embedded PNG outputs"""
+    per_cell = int(size_mb * 1024 * 1024 * 3 / 4 / cells)
+    png = base64.b64encode(os.urandom(per_cell)).decode("ascii")
+    nb = nbformat.v4.new_notebook()
+    for i in range(cells):
+        cell = nbformat.v4.new_code_cell("plot({})".format(i), execution_count=i + 1)
+        cell.outputs.append(
+            nbformat.v4.new_output("display_data", data={"image/png": png})
+        )
+        nb.cells.append(cell)
+    return nbformat.writes(nb)
+
+
+def write_notebooks(directory, count, size_mb, cells):
+    """count copies of a synthetic notebook and a kernel.json, in directory/nb"""
+    notebooks = os.path.join(directory, "nb")
+    os.makedirs(notebooks)
+    nb = make_notebook(size_mb, cells)
+    for i in range(count):
+        with open(os.path.join(notebooks, "{}.ipynb".format(i)), "w") as f:
+            f.write(nb)
+    kernelspec = {
+        "argv": ["python", "-m", "ipykernel_launcher", "-f", "{connection_file}"],
+        "display_name": "Bench",
+        "language": "python",
+    }
+    with open(os.path.join(notebooks, "kernel.json"), "w") as f:
+        json.dump(kernelspec, f)
+    return notebooks
+
+
+class HubUserHandler(web.RequestHandler):
+    """The Hub API's answer about who a token belongs to, for any version of HubAuth"""
+
+    def get(self, token=None):
+        self.write(
+            {
+                "kind": "user",
+                "name": USER,
+                "admin": False,
+                "groups": [],
+                "scopes": ["access:services", "self"],
+            }
+        )
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def listen(app):
+    port = free_port()
+    HTTPServer(app).listen(port, "127.0.0.1")
+    return port
+
+
+async def wait_for(url, process, timeout=60):
+    client = httpclient.AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                "Server for %s exited with %d" % (url, process.returncode)
+            )
+        try:
+            await client.fetch(url, raise_error=False, request_timeout=1)
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("%s didn't start in %d seconds" % (url, timeout))
+
+
+def peak_rss_mb(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+async def drive(urls, concurrency, expected_code, headers=None):
+    """Fetch urls with at most concurrency requests in flight, returning their latencies"""
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = []
+    failures = 0
+    queue = iter(urls)
+
+    async def worker():
+        nonlocal failures
+        for url in queue:
+            start = time.perf_counter()
+            response = await client.fetch(
+                url,
+                headers=headers,
+                follow_redirects=False,
+                raise_error=False,
+                request_timeout=600,
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.code != expected_code:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    client.close()
+    return latencies, elapsed, failures
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def main(args):
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with TemporaryDirectory() as tmp:
+        notebooks = write_notebooks(tmp, args.notebooks, args.size, args.cells)
+        notebook_port = listen(
+            web.Application([(r"/(.*)", web.StaticFileHandler, {"path": tmp})])
+        )
+        hub_port = listen(
+            web.Application(
+                [
+                    (r"/hub/api/user", HubUserHandler),
+                    (r"/hub/api/authorizations/token/(.*)", HubUserHandler),
+                ]
+            )
+        )
+
+        root = os.path.join(tmp, "root")
+        os.makedirs(root)
+        env = dict(
+            os.environ,
+            JUPYTER_DATA_DIR=os.path.join(tmp, "data"),
+            JUPYTERHUB_API_URL="http://127.0.0.1:{}/hub/api".format(hub_port),
+            JUPYTERHUB_API_TOKEN=TOKEN,
+            JUPYTERHUB_BASE_URL="/",
+        )
+        processes = {}
+        server_port = free_port()
+        processes["notebook"] = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                NOTEBOOK_BOOTSTRAP.format(host=NOTEBOOK_HOST),
+                str(notebook_port),
+                "--no-browser",
+                "--allow-root",
+                "--port={}".format(server_port),
+                "--NotebookApp.token=",
+                "--NotebookApp.notebook_dir={}".format(root),
+                "--NotebookApp.nbserver_extensions={'clonenotebooks.cloners': True}",
+                "--CloneNotebooks.http_client=simple",
+            ],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        server_url = "http://127.0.0.1:{}".format(server_port)
+
+        scenarios = args.scenarios
+        if not args.nbviewer:
+            scenarios = [s for s in scenarios if s in NOTEBOOK_SCENARIOS]
+        nbviewer_url = None
+        if args.nbviewer:
+            with open(os.path.join(tmp, "nbviewer_config.py"), "w") as f:
+                f.write(
+                    NBVIEWER_CONFIG.format(
+                        localfiles=tmp,
+                        templates=os.path.join(repo, "templates"),
+                        static=os.path.join(repo, "static"),
+                    )
+                )
+            nbviewer_port = free_port()
+            processes["nbviewer"] = subprocess.Popen(
+                [sys.executable, "-m", "nbviewer", "--port={}".format(nbviewer_port)],
+                cwd=tmp,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            nbviewer_url = "http://127.0.0.1:{}".format(nbviewer_port)
+
+        try:
+            await wait_for(server_url + "/api", processes["notebook"])
+            if nbviewer_url:
+                await wait_for(nbviewer_url, processes["nbviewer"])
+
+            def urls(scenario, n):
+                for i in range(n):
+                    name = "{}.ipynb".format(i % args.notebooks)
+                    if scenario == "url_clone":
+                        yield (
+                            server_url
+                            + "/url_clone?clone_from={}/nb/{}&protocol=http".format(
+                                NOTEBOOK_HOST, name
+                            )
+                            + "&kernelspec_source={}/nb".format(NOTEBOOK_HOST)
+                        )
+                    elif scenario == "local_clone":
+                        yield server_url + "/local_clone?clone_from={}".format(
+                            os.path.join(notebooks, name)
+                        )
+                    elif scenario == "render_clone":
+                        yield nbviewer_url + "/localfile/nb/{}?clone".format(name)
+                    elif scenario == "url_redirect":
+                        yield nbviewer_url + "/url/127.0.0.1:{}/nb/{}?clone".format(
+                            notebook_port, name
+                        )
+                    else:
+                        yield nbviewer_url + "/url/127.0.0.1:{}/nb/{}".format(
+                            notebook_port, name
+                        )
+
+            if not args.json:
+                print(
+                    "{:>13} {:>5} {:>9} {:>9} {:>9} {:>6} {:>12} {:>12}".format(
+                        "scenario",
+                        "conc",
+                        "p50_ms",
+                        "p99_ms",
+                        "req/s",
+                        "fails",
+                        "nb_rss_mb",
+                        "viewer_rss_mb",
+                    )
+                )
+            for scenario in scenarios:
+                expected_code = 200 if scenario == "render" else 302
+                headers = {"Authorization": "token " + TOKEN}
+                for concurrency in args.concurrency:
+                    latencies, elapsed, failures = await drive(
+                        urls(scenario, args.requests),
+                        concurrency,
+                        expected_code,
+                        headers=headers,
+                    )
+                    result = {
+                        "scenario": scenario,
+                        "concurrency": concurrency,
+                        "requests": len(latencies),
+                        "p50_ms": percentile(latencies, 50) * 1000,
+                        "p99_ms": percentile(latencies, 99) * 1000,
+                        "throughput": len(latencies) / elapsed,
+                        "failures": failures,
+                        "notebook_rss_mb": peak_rss_mb(processes["notebook"].pid),
+                        "nbviewer_rss_mb": peak_rss_mb(processes["nbviewer"].pid)
+                        if "nbviewer" in processes
+                        else float("nan"),
+                    }
+                    if args.json:
+                        print(json.dumps(result))
+                    else:
+                        print(
+                            "{scenario:>13} {concurrency:>5} {p50_ms:>9.1f} {p99_ms:>9.1f} "
+                            "{throughput:>9.1f} {failures:>6} {notebook_rss_mb:>12.1f} "
+                            "{nbviewer_rss_mb:>12.1f}".format(**result)
+                        )
+        finally:
+            for process in processes.values():
+                process.terminate()
+                process.wait()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--size", type=float, default=1, help="notebook size in MB")
+    parser.add_argument("--cells", type=int, default=50)
+    parser.add_argument(
+        "--notebooks", type=int, default=10, help="number of distinct notebooks"
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument(
+        "--no-nbviewer",
+        dest="nbviewer",
+        action="store_false",
+        help="only run the notebook server's scenarios",
+    )
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
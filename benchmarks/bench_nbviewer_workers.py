@@ -0,0 +1,165 @@
+"""Render throughput of nbviewer with the clonenotebooks renderers, by number of workers
+
+Starts a stand-in for the JupyterHub API, then for each number of workers
+clonenotebooks-nbviewer with that many nbviewer processes and its cache turned off, and
+has it render synthetic local notebooks at the given concurrency, e.g.
+
+    python benchmarks/bench_nbviewer_workers.py --workers 1 4 --concurrency 4 16
+
+Every request is a full nbconvert render, which is what one process serializes, so
+throughput should grow with the number of workers up to the number of CPUs.
+--json prints the results as JSON lines instead.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+from tornado import web
+
+from bench_load import (
+    TOKEN,
+    HubUserHandler,
+    drive,
+    free_port,
+    listen,
+    peak_rss_mb,
+    percentile,
+    wait_for,
+    write_notebooks,
+)
+
+NBVIEWER_CONFIG = """
+c.NBViewer.handler_settings = {{"clone_notebooks": True, "clone_to_directory": "/"}}
+c.NBViewer.local_handler = "clonenotebooks.renderers.LocalRenderingHandler"
+c.NBViewer.localfiles = {localfiles!r}
+c.NBViewer.template_path = {templates!r}
+c.NBViewer.static_path = {static!r}
+"""
+
+
+def children_rss_mb(pid):
+    """Peak RSS of the workers forked by pid, added up (Linux only)"""
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return float("nan")
+    return sum(peak_rss_mb(child) for child in children) or peak_rss_mb(pid)
+
+
+async def main(args):
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with TemporaryDirectory() as tmp:
+        write_notebooks(tmp, args.notebooks, args.size, args.cells)
+        hub_port = listen(
+            web.Application(
+                [
+                    (r"/hub/api/user", HubUserHandler),
+                    (r"/hub/api/authorizations/token/(.*)", HubUserHandler),
+                ]
+            )
+        )
+        with open(os.path.join(tmp, "nbviewer_config.py"), "w") as f:
+            f.write(
+                NBVIEWER_CONFIG.format(
+                    localfiles=tmp,
+                    templates=os.path.join(repo, "templates"),
+                    static=os.path.join(repo, "static"),
+                )
+            )
+        env = dict(
+            os.environ,
+            JUPYTERHUB_API_URL="http://127.0.0.1:{}/hub/api".format(hub_port),
+            JUPYTERHUB_API_TOKEN=TOKEN,
+            JUPYTERHUB_BASE_URL="/",
+        )
+
+        if not args.json:
+            print(
+                "{:>7} {:>5} {:>9} {:>9} {:>9} {:>6} {:>12}".format(
+                    "workers", "conc", "p50_ms", "p99_ms", "req/s", "fails", "rss_mb"
+                )
+            )
+        for workers in args.workers:
+            port = free_port()
+            nbviewer = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "clonenotebooks.workers",
+                    "--port={}".format(port),
+                    "--no-cache",
+                    "--NBViewerWorkers.workers={}".format(workers),
+                    # Needed for more than one worker, though --no-cache leaves it unused
+                    "--NBViewerWorkers.shared_cache_dir={}".format(
+                        os.path.join(tmp, "cache")
+                    ),
+                ],
+                cwd=tmp,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            url = "http://127.0.0.1:{}".format(port)
+            try:
+                await wait_for(url, nbviewer)
+
+                def urls(n):
+                    for i in range(n):
+                        yield url + "/localfile/nb/{}.ipynb".format(i % args.notebooks)
+
+                for concurrency in args.concurrency:
+                    latencies, elapsed, failures = await drive(
+                        urls(args.requests),
+                        concurrency,
+                        200,
+                        headers={"Authorization": "token " + TOKEN},
+                    )
+                    result = {
+                        "workers": workers,
+                        "concurrency": concurrency,
+                        "requests": len(latencies),
+                        "p50_ms": percentile(latencies, 50) * 1000,
+                        "p99_ms": percentile(latencies, 99) * 1000,
+                        "throughput": len(latencies) / elapsed,
+                        "failures": failures,
+                        "rss_mb": children_rss_mb(nbviewer.pid),
+                    }
+                    if args.json:
+                        print(json.dumps(result))
+                    else:
+                        print(
+                            "{workers:>7} {concurrency:>5} {p50_ms:>9.1f} {p99_ms:>9.1f} "
+                            "{throughput:>9.1f} {failures:>6} {rss_mb:>12.1f}".format(
+                                **result
+                            )
+                        )
+            finally:
+                # The workers exit along with it
+                nbviewer.terminate()
+                nbviewer.wait()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1]
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16])
+    parser.add_argument("--size", type=float, default=1, help="notebook size in MB")
+    parser.add_argument("--cells", type=int, default=50)
+    parser.add_argument(
+        "--notebooks", type=int, default=10, help="number of distinct notebooks"
+    )
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,168 @@
+"""Smoke test of clonenotebooks-nbviewer with two workers and lazy rendering
+
+Starts a stand-in for the JupyterHub API and clonenotebooks-nbviewer with two nbviewer
+processes sharing a cache directory, renders a synthetic local notebook long enough to
+be loaded lazily, then fetches each of its lazily loaded sections several times over
+new connections, so that they're asked for from both workers. Also checks that two
+workers without a shared cache are refused. Exits with an error if anything fails, e.g.
+
+    python benchmarks/smoke_nbviewer_workers.py
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+from tornado import httpclient, web
+
+from clonenotebooks.workers import MEMCACHE_VARIABLES
+
+from bench_load import (
+    TOKEN,
+    HubUserHandler,
+    free_port,
+    listen,
+    wait_for,
+    write_notebooks,
+)
+
+NBVIEWER_CONFIG = """
+from nbviewer.providers import default_providers
+c.NBViewer.providers = default_providers + ["clonenotebooks.renderers.lazy"]
+c.NBViewer.handler_settings = {{
+    "clone_notebooks": True,
+    "clone_to_directory": "/",
+    "lazy_render_cells": {cells_per_section},
+}}
+c.NBViewer.local_handler = "clonenotebooks.renderers.LocalRenderingHandler"
+c.NBViewer.localfiles = {localfiles!r}
+c.NBViewer.template_path = {templates!r}
+c.NBViewer.static_path = {static!r}
+"""
+
+LAZY_URL = re.compile(r'data-src="([^"]*/clonenotebooks/lazy/[0-9a-f]{40})"')
+
+
+def start_nbviewer(tmp, env, port, *options, stderr=None):
+    return subprocess.Popen(
+        [sys.executable, "-m", "clonenotebooks.workers", "--port={}".format(port)]
+        + list(options),
+        cwd=tmp,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=stderr,
+    )
+
+
+async def fetch(url, expected_code=200):
+    # A new client, and so a new connection, which the kernel gives to either worker
+    client = httpclient.AsyncHTTPClient(force_instance=True)
+    try:
+        response = await client.fetch(
+            url,
+            headers={"Authorization": "token " + TOKEN},
+            raise_error=False,
+            request_timeout=120,
+        )
+    finally:
+        client.close()
+    if response.code != expected_code:
+        raise AssertionError(
+            "%s answered %d instead of %d" % (url, response.code, expected_code)
+        )
+    return response.body.decode("utf-8")
+
+
+async def main(args):
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with TemporaryDirectory() as tmp:
+        write_notebooks(tmp, 1, args.size, args.cells)
+        hub_port = listen(
+            web.Application(
+                [
+                    (r"/hub/api/user", HubUserHandler),
+                    (r"/hub/api/authorizations/token/(.*)", HubUserHandler),
+                ]
+            )
+        )
+        with open(os.path.join(tmp, "nbviewer_config.py"), "w") as f:
+            f.write(
+                NBVIEWER_CONFIG.format(
+                    cells_per_section=args.cells_per_section,
+                    localfiles=tmp,
+                    templates=os.path.join(repo, "templates"),
+                    static=os.path.join(repo, "static"),
+                )
+            )
+        env = dict(
+            os.environ,
+            JUPYTERHUB_API_URL="http://127.0.0.1:{}/hub/api".format(hub_port),
+            JUPYTERHUB_API_TOKEN=TOKEN,
+            JUPYTERHUB_BASE_URL="/",
+        )
+        for name in MEMCACHE_VARIABLES:
+            env.pop(name, None)
+
+        unshared = start_nbviewer(
+            tmp, env, free_port(), "--NBViewerWorkers.workers=2", stderr=subprocess.PIPE
+        )
+        _, stderr = unshared.communicate(timeout=60)
+        if unshared.returncode == 0 or b"shared cache" not in stderr:
+            raise AssertionError("Two workers without a shared cache weren't refused")
+        print("ok: two workers without a shared cache are refused")
+
+        port = free_port()
+        nbviewer = start_nbviewer(
+            tmp,
+            env,
+            port,
+            "--NBViewerWorkers.workers=2",
+            "--NBViewerWorkers.shared_cache_dir={}".format(os.path.join(tmp, "cache")),
+        )
+        url = "http://127.0.0.1:{}".format(port)
+        try:
+            await wait_for(url, nbviewer)
+            page = await fetch(url + "/localfile/nb/0.ipynb")
+            sections = LAZY_URL.findall(page)
+            if not sections:
+                raise AssertionError("The notebook wasn't rendered lazily")
+            print("ok: rendered the notebook, with a lazily loaded section")
+
+            # Each section is in the cache by the time the page is sent
+            seen = set()
+            while sections:
+                section = sections.pop()
+                for _ in range(args.repeat):
+                    body = await fetch(url + section)
+                seen.add(section)
+                sections.extend(
+                    found for found in LAZY_URL.findall(body) if found not in seen
+                )
+            print(
+                "ok: fetched {} lazily loaded sections {} times each".format(
+                    len(seen), args.repeat
+                )
+            )
+        finally:
+            # The workers exit along with it
+            nbviewer.terminate()
+            nbviewer.wait()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=0.1, help="notebook size in MB")
+    parser.add_argument("--cells", type=int, default=20)
+    parser.add_argument("--cells-per-section", type=int, default=5)
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="fetches of each lazily loaded section"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from functools import partial
+import time
+
+from tornado import httpclient
+
+from ..metrics import CACHE_REQUESTS
+from ..utils import SingleFlight
+
+# Responses that mean "there is nothing at this URL", as opposed to a transient failure
+MISSING_CODES = (404, 410)
+
+
+class CacheEntry:
+    """A cached response, or a cached miss if error is set"""
+
+    def __init__(self, response=None, error=None, ttl=0):
+        self.response = response
+        self.error = error
+        self.size = len(response.body) if response is not None else 0
+        self.etag = response.headers.get("ETag") if response is not None else None
+        self.last_modified = (
+            response.headers.get("Last-Modified") if response is not None else None
+        )
+        self.refresh(ttl)
+
+    def refresh(self, ttl):
+        self.expires = time.monotonic() + ttl
+
+    @property
+    def fresh(self):
+        return time.monotonic() < self.expires
+
+    @property
+    def revalidatable(self):
+        return self.error is None and (self.etag or self.last_modified)
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class ResponseCache:
+    """Size-bounded LRU cache of upstream responses, shared by every clone on the server
+
+    Responses are kept for `ttl` seconds, and misses (404s, which are the usual
+    answer to a kernel.json probe) for `miss_ttl` seconds. With `revalidate`, an
+    expired response that has an ETag or Last-Modified header is kept and checked
+    with a conditional request instead of being downloaded again.
+
+    Concurrent fetches of the same URL share a single request upstream.
+    """
+
+    def __init__(self, max_bytes, ttl, miss_ttl, revalidate=True, log=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.revalidate = revalidate
+        self.log = log
+        self.size = 0
+        self._entries = OrderedDict()
+        self._flights = SingleFlight()
+
+    async def fetch(self, url, fetch):
+        """Return the response for url, calling fetch(url, headers=...) if it isn't cached
+
+        Raises the same errors as fetch, including cached misses.
+        """
+        if self.max_bytes <= 0:
+            CACHE_REQUESTS.labels("disabled").inc()
+            return await fetch(url)
+
+        entry = self._entries.get(url)
+        if entry is not None and entry.fresh:
+            CACHE_REQUESTS.labels("hit").inc()
+            self._entries.move_to_end(url)
+            return entry.result()
+
+        if url in self._flights:
+            CACHE_REQUESTS.labels("coalesced").inc()
+        else:
+            CACHE_REQUESTS.labels("miss").inc()
+        entry = await self._flights.run(url, partial(self._refresh, url, entry, fetch))
+        return entry.result()
+
+    async def _refresh(self, url, entry, fetch):
+        headers = {}
+        if entry is not None and self.revalidate and entry.revalidatable:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        try:
+            response = await fetch(url, headers=headers)
+        except httpclient.HTTPError as e:
+            if e.code == 304 and headers:
+                CACHE_REQUESTS.labels("revalidated").inc()
+                if self.log:
+                    self.log.debug("Revalidated cached response for %s", url)
+                entry.refresh(self.ttl)
+                self._entries.move_to_end(url)
+                return entry
+            if e.code in MISSING_CODES:
+                new_entry = CacheEntry(error=e, ttl=self.miss_ttl)
+            else:
+                raise
+        else:
+            new_entry = CacheEntry(response=response, ttl=self.ttl)
+            if getattr(response, "spool", None) is not None:
+                # Spooled to disk because it was too large to keep in memory,
+                # so it's shared with concurrent fetches but not cached
+                return new_entry
+
+        self._store(url, new_entry)
+        return new_entry
+
+    def add(self, url, response):
+        """Cache a response for url that was fetched some other way, e.g. by a sync"""
+        if self.max_bytes > 0 and getattr(response, "spool", None) is None:
+            self._store(url, CacheEntry(response=response, ttl=self.ttl))
+
+    def _store(self, url, entry):
+        self.discard(url)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[url] = entry
+        self.size += entry.size
+        self._evict()
+
+    def _evict(self):
+        # Expired entries go first, unless they can still be revalidated
+        for url, entry in list(self._entries.items()):
+            if not entry.fresh and not (self.revalidate and entry.revalidatable):
+                self.discard(url)
+        while self.size > self.max_bytes:
+            url = next(iter(self._entries))
+            self.discard(url)
+
+    def discard(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry.size
@@ -1,17 +1,63 @@
+from abc import ABCMeta, abstractmethod
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+import inspect
 import json
 import os.path
+from urllib.parse import quote, unquote
 
+from jinja2 import ChoiceLoader, FileSystemLoader
+import nbformat
 from notebook.utils import url_path_join
-from notebook.base.handlers import IPythonHandler
+from notebook.base.handlers import APIHandler, IPythonHandler
 from notebook.services.contents.manager import copy_pat
-import nbformat
-from tornado import web, httpclient
-from tornado.escape import url_unescape, url_escape
-from ..utils import response_text
+from tornado import web, httpclient, locks
+from tornado.ioloop import IOLoop
+from ..metrics import (
+    CLONE_ERRORS,
+    COALESCED_REQUESTS,
+    FETCHED_BYTES,
+    KERNELSPEC_MISSING,
+    STAGE_SECONDS,
+    url_provider,
+)
+from ..utils import SingleFlight, response_text
+from .cache import ResponseCache
+from .client import make_client
+from .config import CloneNotebooks
+from .convert import notebook_content
+from .dedup import DedupStore
+from .download import (
+    DownloadTooLarge,
+    SpooledNotebook,
+    StreamedBody,
+    response_notebook,
+)
+from .fastcopy import NotebookFile, copy_notebook, notebook_file
+from .jobs import JobQueue
+from .kernelspecs import KernelspecInstaller
+from .names import create_new, next_free_name
+from .sync import SYNC_POLICIES, SyncIndex, file_digest, file_state, text_digest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Reserved and unreserved characters of RFC 3986, plus "%" for existing escapes
+URL_SAFE = "!#$%&'()*+,/:;=?@[]~"
+
+# CloneHandler.option's default, for arguments that are required
+MISSING = object()
+
 
-from tempfile import TemporaryDirectory
-from jupyter_client.kernelspec import install_kernel_spec
+def read_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
 
 
 def load_jupyter_server_extension(nb_server_app):
@@ -23,18 +69,382 @@ def load_jupyter_server_extension(nb_server_app):
     """
     web_app = nb_server_app.web_app
     contents_manager = nb_server_app.contents_manager
+    clone_config = CloneNotebooks(parent=nb_server_app)
+    response_cache = ResponseCache(
+        max_bytes=clone_config.cache_max_bytes,
+        ttl=clone_config.cache_ttl,
+        miss_ttl=clone_config.cache_miss_ttl,
+        revalidate=clone_config.cache_revalidate,
+        log=nb_server_app.log,
+    )
+    kernelspec_installer = KernelspecInstaller(
+        nb_server_app.kernel_spec_manager.user_kernel_dir
+    )
+    # Filesystem work, parsing and kernelspec installation happen on these threads,
+    # so a slow shared filesystem doesn't stall the server's other traffic
+    clone_executor = ThreadPoolExecutor(
+        max_workers=clone_config.executor_workers,
+        thread_name_prefix="clonenotebooks",
+    )
+    # e.g. FileContentsManager, whose files can be listed and created directly
+    local_files = hasattr(contents_manager, "_get_os_path")
+    dedup_store = None
+    if clone_config.dedup_store_dir:
+        if not local_files:
+            nb_server_app.log.warning(
+                "Not using the dedup store: %s doesn't save to the local filesystem",
+                type(contents_manager).__name__,
+            )
+        elif contents_manager.pre_save_hook or contents_manager.post_save_hook:
+            nb_server_app.log.warning(
+                "Not using the dedup store: its clones would skip the save hooks"
+            )
+        else:
+            dedup_store = DedupStore(
+                clone_config.dedup_store_dir, clone_config.dedup_link_mode
+            )
+    # Local notebooks are then serialized and written on the executor, rather than saved
+    # by contents_manager.save on the event loop. Like the copies below, they don't get
+    # a checkpoint until they're first saved.
+    direct_save = (
+        local_files
+        and hasattr(contents_manager, "_save_notebook")
+        and not (contents_manager.pre_save_hook or contents_manager.post_save_hook)
+    )
+    # Local v4 notebooks are copied as they are, see clonenotebooks.cloners.fastcopy,
+    # unless they'd skip the store or the save hooks
+    fast_copy = (
+        clone_config.local_fast_copy
+        and local_files
+        and dedup_store is None
+        and not (contents_manager.pre_save_hook or contents_manager.post_save_hook)
+    )
+    clone_slots = locks.Semaphore(clone_config.max_concurrent_clones)
+    # Held from picking a free file name until the clone is saved under it
+    save_lock = locks.Lock()
+    # Concurrent clones of the same source share one fetch
+    fetch_flights = SingleFlight()
+    clone_jobs = JobQueue(
+        workers=clone_config.clone_job_workers,
+        ttl=clone_config.clone_job_ttl,
+        log=nb_server_app.log,
+    )
+
+    async def run_blocking(func, *args, **kwargs):
+        """Run func on the clone executor, or just await it if it's already async
+
+        e.g. the methods of an async contents manager
+        """
+        if inspect.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        return await IOLoop.current().run_in_executor(
+            clone_executor, partial(func, *args, **kwargs)
+        )
 
     # This class is defined in line so it can close over contents_manager.
-    class CloneHandler(IPythonHandler):
-        def clone_to_directory(self, nb, clone_from, clone_to):
-            # convert notebook to current format
-            nbnode = nbformat.reads(nb, as_version=4)
-            nb = nbformat.writes(nbnode)
-            # change string to JSON object
-            nbjson = json.loads(nb)
+    class CloneHandler(IPythonHandler, metaclass=ABCMeta):
+        # Label for the metrics, set per notebook where it isn't known in advance
+        provider = "url"
+        # The CloneJob this clone runs as, if it runs in the background
+        job = None
+        # The SyncIndex of the directory this clone syncs into, if it's a sync
+        sync = None
+
+        def __init_subclass__(cls, **kwargs):
+            # Rather than on its first request
+            super().__init_subclass__(**kwargs)
+            missing = sorted(
+                name
+                for name in CloneHandler.__abstractmethods__
+                if getattr(getattr(cls, name), "__isabstractmethod__", False)
+            )
+            if missing:
+                raise TypeError(
+                    "%s doesn't implement %s" % (cls.__name__, ", ".join(missing))
+                )
+
+        @web.authenticated
+        async def get(self):
+            self.options = {
+                name: self.get_query_arguments(name)
+                for name in self.request.query_arguments
+            }
+            if "job" in self.options:
+                # Answered straight away, with a page to follow the clone's progress on
+                job = clone_jobs.submit(
+                    self.run_clone, user=self.current_user, options=self.options
+                )
+                self.log.info("Queued clone job %s", job.id)
+                self.redirect(url_path_join(self.base_url, "clone_jobs", job.id))
+                return
+
+            await self.run_clone()
+
+        async def run_clone(self, job=None):
+            """Clone what options ask for, or job.options for a job
+
+            A job runs after its request is finished, so the clone only goes by the
+            job's own state from here on, and doesn't look at the request again.
+            """
+            if job is not None:
+                self.job = job
+                self.options = job.options
+            # Clones beyond max_concurrent_clones wait here for their turn
+            async with clone_slots:
+                try:
+                    await self.clone()
+                except Exception as e:
+                    CLONE_ERRORS.labels(
+                        self.provider, getattr(e, "status_code", 500)
+                    ).inc()
+                    raise
+
+        def option(self, name, default=MISSING):
+            """The clone's last name argument, or default, like get_query_argument"""
+            values = self.options.get(name)
+            if values:
+                return values[-1]
+            if default is MISSING:
+                raise web.MissingArgumentError(name)
+            return default
+
+        @abstractmethod
+        async def clone(self):
+            raise NotImplementedError
+
+        async def fetch_source(self, source, checked=None):
+            """Fetch what's needed to clone source, sharing the work with concurrent clones of it
+
+            Returns (notebook, kernelspec, kernel_name), see fetch_new_source. checked is
+            what check_source already fetched of source, if anything, so it isn't fetched again.
+            """
+            self.set_stage("fetch")
+            key = self.source_key(source)
+            if key in fetch_flights:
+                COALESCED_REQUESTS.labels("fetch").inc()
+            try:
+                return await fetch_flights.run(
+                    key,
+                    partial(self.fetch_new_source, source, checked),
+                    timeout=clone_config.clone_deadline,
+                )
+            except asyncio.TimeoutError:
+                raise web.HTTPError(
+                    504, "Timed out waiting for a concurrent fetch of %s" % source
+                )
+
+        @abstractmethod
+        def source_key(self, source):
+            """What identifies the result of fetch_new_source(source)"""
+            raise NotImplementedError
+
+        @abstractmethod
+        async def fetch_new_source(self, source, checked=None):
+            raise NotImplementedError
+
+        def sync_policy(self):
+            """The policy of a sync (see clonenotebooks.cloners.sync), or None if this isn't one
+
+            From the sync argument, which is either a policy or just there for sync_policy's.
+            """
+            policy = self.option("sync", default=None)
+            if policy is None:
+                return None
+            policy = policy.lower()
+            if policy in ("", "1", "true"):
+                return clone_config.sync_policy
+            if policy not in SYNC_POLICIES:
+                raise web.HTTPError(400, "Invalid sync policy: %s" % policy)
+            return policy
+
+        async def open_sync(self, directory):
+            """Load the index of what was synced into directory, if this is a sync"""
+            if self.sync_policy() is None:
+                return
+            if not local_files:
+                raise web.HTTPError(
+                    400, "Syncing needs the notebooks saved to the local filesystem"
+                )
+            self.sync = await run_blocking(
+                SyncIndex.load, contents_manager._get_os_path(directory), self.log
+            )
+            # The validators of the sources fetched, until they're recorded in the index
+            self.sync_validators = {}
+
+        @abstractmethod
+        def sync_key(self, source):
+            """What the sync index knows source by"""
+            raise NotImplementedError
+
+        @abstractmethod
+        async def check_source(self, source, entry):
+            """Whether source might have changed since it was synced as entry
+
+            Returns (validators, checked) if so, where validators are to be recorded for
+            source and checked is what was fetched of it to find out, for fetch_source
+            to use rather than fetch it again. Returns None if it's unchanged.
+            """
+            raise NotImplementedError
+
+        async def fetch_changed(self, source):
+            """fetch_source(source), except that a sync returns None if source is unchanged"""
+            if self.sync is None:
+                return await self.fetch_source(source)
+
+            key = self.sync_key(source)
+            entry = await run_blocking(self.sync.entry, key)
+            self.set_stage("fetch")
+            checked = await self.check_source(source, entry)
+            if checked is None:
+                self.log.info("%s is unchanged since it was synced", source)
+                return None
+            validators, checked = checked
+
+            nb, kernelspec, kernel_name = await self.fetch_source(source, checked)
+            if isinstance(nb, NotebookFile):
+                digest = await run_blocking(file_digest, nb.path)
+            elif isinstance(nb, SpooledNotebook):
+                # Digested as it was read from the spool
+                digest = nb.sha256
+            else:
+                digest = await run_blocking(text_digest, nb)
+            validators["sha256"] = digest
+            if entry is not None and entry.get("sha256") == validators["sha256"]:
+                # A new version upstream, but with the same content
+                self.log.info("%s is unchanged since it was synced", source)
+                self.sync.update(key, **validators)
+                return None
+            self.sync_validators[key] = validators
+            return nb, kernelspec, kernel_name
+
+        async def record_synced(self, clone_from, name):
+            """Record in the sync index that clone_from was just saved as name, if this is a sync"""
+            if self.sync is not None:
+                key = self.sync_key(clone_from)
+                await run_blocking(
+                    self.sync.record, key, name, self.sync_validators.pop(key, {})
+                )
+
+        async def save_sync_index(self):
+            async with save_lock:
+                await run_blocking(self.sync.save)
+
+        async def replace_synced(self, model, clone_from, clone_to):
+            """Save model over the earlier sync of clone_from, if the sync policy allows it
+
+            That's with the "replace" policy, if the earlier sync wasn't edited since.
+            Returns the path it was saved as, or None if it's to be saved as a new file.
+            """
+            if self.sync is None or self.sync_policy() != "replace":
+                return None
+            entry = self.sync.sources.get(self.sync_key(clone_from))
+            if entry is None or not await run_blocking(self.sync.unedited, entry):
+                return None
+
+            path = os.path.join(clone_to, entry["name"])
+            os_path = contents_manager._get_os_path(path)
+            # Kept until the new version is saved
+            backup = os.path.join(
+                os.path.dirname(os_path), ".%s.clonenotebooks-old" % entry["name"]
+            )
+            await run_blocking(os.replace, os_path, backup)
+            try:
+                with STAGE_SECONDS.labels("save", self.provider).time():
+                    await self.save_new(model, path)
+            except Exception:
+                await run_blocking(os.replace, backup, os_path)
+                raise
+            await run_blocking(os.remove, backup)
+            await self.record_synced(clone_from, entry["name"])
+            return path
+
+        async def clone_to_directory(self, nb, clone_from, clone_to):
+            model = await self.notebook_model(nb, clone_from)
+            [full_clone_to] = await self.save_notebooks([(clone_from, model)], clone_to)
+            with STAGE_SECONDS.labels("redirect", self.provider).time():
+                self.cloned(full_clone_to)
+
+        async def clone_changed(self, source, clone_to):
+            """Clone source into clone_to, or if this is a sync, only if it changed since"""
+            await self.open_sync(clone_to)
+            fetched = await self.fetch_changed(source)
+            if fetched is None:
+                await self.save_sync_index()
+                key = self.sync_key(source)
+                self.cloned(os.path.join(clone_to, self.sync.sources[key]["name"]))
+                return
+            nb, kernelspec, kernel_name = fetched
+
+            # Try to install the kernelspec, but even if this fails clone notebook anyway
+            try:
+                await self.clone_kernelspec(kernelspec, kernel_name)
+            except Exception as e:
+                self.log.warning("Failed to install kernelspec.")
+                self.log.warning(e)
+
+            await self.clone_to_directory(nb, source, clone_to)
+
+        def cloned(self, path):
+            """Send the user to path in JupyterLab, or leave it for the progress page to"""
+            if self.job is not None:
+                self.job.finish(url_path_join(self.base_url, "lab", "tree", path))
+            else:
+                self.redirect(url_path_join("lab", "tree", path))
+
+        def set_stage(self, stage):
+            """Show that the clone is at stage, one of those of STAGE_SECONDS, if it's a job"""
+            if self.job is not None:
+                self.job.stage = stage
+
+        def output_options(self):
+            """How to reduce the clone's outputs, from the strip_outputs and max_output_bytes arguments
+
+            Keyword arguments for notebook_content.
+            """
+            strip_outputs = self.option("strip_outputs", default=None)
+            max_output_bytes = self.option("max_output_bytes", default="0")
+            try:
+                max_output_bytes = int(max_output_bytes or 0)
+            except ValueError:
+                raise web.HTTPError(
+                    400, "Invalid max_output_bytes: %s" % max_output_bytes
+                )
+            return {
+                "strip_outputs": strip_outputs not in (None, "0", "false"),
+                "max_output_bytes": max(max_output_bytes, 0),
+            }
+
+        async def notebook_model(self, nb, clone_from):
+            self.set_stage("parse")
+            options = self.output_options()
+            if isinstance(nb, NotebookFile):
+                if not any(options.values()):
+                    return {"type": "notebook", "copy_from": nb.path}
+                # Its outputs are to be reduced, so it's parsed after all
+                nb = await run_blocking(read_bytes, nb.path)
+            # The store keeps notebooks as fetched, so reduced clones are saved on their own
+            if (
+                dedup_store is not None
+                and isinstance(nb, (str, bytes))
+                and not any(options.values())
+            ):
+                model = await self.dedup_model(nb, clone_from)
+                if model is not None:
+                    return model
+
+            # nb can be JSON text or an already-parsed notebook, either way it's only parsed once,
+            # and its outputs are reduced as it's parsed
+            try:
+                with STAGE_SECONDS.labels("parse", self.provider).time():
+                    nbjson = await run_blocking(notebook_content, nb, **options)
+            except Exception as e:
+                self.log.error(
+                    "Failed to read notebook from %s", clone_from, exc_info=True
+                )
+                raise web.HTTPError(400, "Not a valid notebook: %s" % e)
 
             now = datetime.now()
-            model = {
+            return {
                 "content": nbjson,
                 "created": now,
                 "format": "json",
@@ -43,102 +453,316 @@ def load_jupyter_server_extension(nb_server_app):
                 "type": "notebook",
                 "writable": True,
             }
-            name = copy_pat.sub(u".", os.path.basename(clone_from))
+
+        async def dedup_model(self, nb, clone_from):
+            """A model for a notebook that save_notebooks clones from dedup_store
+
+            The notebook is only parsed the first time that version of it is cloned.
+            Returns None if it isn't kept in the store, see DedupStore.add.
+            """
+            data = nb.encode("utf-8") if isinstance(nb, str) else nb
+            try:
+                with STAGE_SECONDS.labels("parse", self.provider).time():
+                    digest = await run_blocking(dedup_store.add, data)
+            except Exception as e:
+                self.log.error(
+                    "Failed to read notebook from %s", clone_from, exc_info=True
+                )
+                raise web.HTTPError(400, "Not a valid notebook: %s" % e)
+            if digest is None:
+                return None
+            # Kept in case the stored copy was tampered with, see DedupStore.clone
+            return {"type": "notebook", "dedup_digest": digest, "dedup_data": data}
+
+        async def save_notebooks(self, models, clone_to):
+            """Save (clone_from, model) pairs into clone_to, returning the path each was saved to
+
+            File names are picked and the notebooks saved in a single pass under save_lock.
+            """
             # Note: clone destination is relative to root directory of notebook server
             self.log.debug(
                 "Intended clone destination: %s",
                 os.path.normpath(os.path.join(contents_manager.root_dir, clone_to)),
             )
-            to_name = contents_manager.increment_filename(
-                filename=name, path=clone_to, insert="-Copy"
-            )
-            full_clone_to = os.path.join(clone_to, to_name)
-            contents_manager.save(model, full_clone_to)
-            self.redirect(url_path_join("lab", "tree", full_clone_to))
+            paths = []
+            self.set_stage("save")
+            async with save_lock:
+                taken = await self.taken_names(clone_to)
+                for clone_from, model in models:
+                    replaced = await self.replace_synced(model, clone_from, clone_to)
+                    if replaced is not None:
+                        paths.append(replaced)
+                        continue
+
+                    name = copy_pat.sub(u".", self.source_name(clone_from))
+                    while True:
+                        if taken is None:
+                            to_name = await run_blocking(
+                                contents_manager.increment_filename,
+                                filename=name,
+                                path=clone_to,
+                                insert="-Copy",
+                            )
+                        else:
+                            to_name = next_free_name(name, taken, insert="-Copy")
+                            taken.add(to_name)
+                        full_clone_to = os.path.join(clone_to, to_name)
+                        try:
+                            with STAGE_SECONDS.labels("save", self.provider).time():
+                                await self.save_new(model, full_clone_to)
+                        except FileExistsError:
+                            # Created since the directory was listed, so try the next name
+                            self.log.debug("%s was taken, trying another name", to_name)
+                            continue
+                        break
+                    paths.append(full_clone_to)
+                    await self.record_synced(clone_from, to_name)
+                if self.sync is not None:
+                    await run_blocking(self.sync.save)
+            return paths
+
+        def source_name(self, clone_from):
+            """The file name a notebook cloned from clone_from is given"""
+            return os.path.basename(clone_from)
+
+        async def taken_names(self, directory):
+            """The names in directory, from a single listing, or None if it can't be listed"""
+            if not local_files:
+                return None
+            try:
+                names = await run_blocking(
+                    os.listdir, contents_manager._get_os_path(directory)
+                )
+            except (FileNotFoundError, NotADirectoryError):
+                raise web.HTTPError(404, "No such directory: %s" % directory)
+            return set(names)
+
+        async def save_new(self, model, path):
+            """Save model as path, raising FileExistsError if there's something there already"""
+            if "dedup_digest" in model:
+                method = await run_blocking(
+                    dedup_store.clone,
+                    model["dedup_digest"],
+                    contents_manager._get_os_path(path),
+                    model["dedup_data"],
+                )
+                self.log.debug("Cloned %s by %s", path, method)
+                return
+
+            if "copy_from" in model:
+                try:
+                    method = await run_blocking(
+                        copy_notebook,
+                        model["copy_from"],
+                        contents_manager._get_os_path(path),
+                    )
+                except ValueError as e:
+                    raise web.HTTPError(400, "Not a valid notebook: %s" % e)
+                self.log.debug("Cloned %s by %s", path, method)
+                return
+
+            if local_files:
+                # Claim the name first, since save would overwrite whatever is there
+                os_path = contents_manager._get_os_path(path)
+                await run_blocking(create_new, os_path)
+            try:
+                if direct_save:
+                    nb = await run_blocking(nbformat.from_dict, model["content"])
+                    # On the event loop: trusted notebooks are signed in nbformat's SQLite
+                    # signature store, which only works from the thread that opened it
+                    contents_manager.check_and_sign(nb, path)
+                    await run_blocking(contents_manager._save_notebook, os_path, nb)
+                elif inspect.iscoroutinefunction(contents_manager.save):
+                    await contents_manager.save(model, path)
+                else:
+                    # Not on the executor, for the signature store
+                    contents_manager.save(model, path)
+            except Exception:
+                if local_files:
+                    await run_blocking(os.remove, os_path)
+                raise
 
-        def clone_kernelspec(self, kernelspec, kernel_name):
+        async def clone_kernelspec(self, kernelspec, kernel_name):
             if kernelspec is not None:
-                with TemporaryDirectory() as tmpdir:
-                    with open(os.path.join(tmpdir, "kernel.json"), "w+") as tmpfile:
-                        tmpfile.write(kernelspec)
-                    install_kernel_spec(
-                        source_dir=tmpdir, kernel_name=kernel_name, user=True
+                self.set_stage("kernelspec_install")
+                with STAGE_SECONDS.labels("kernelspec_install", self.provider).time():
+                    installed = await run_blocking(
+                        kernelspec_installer.install, kernelspec, kernel_name
                     )
+                if installed:
+                    self.log.info("Installed kernelspec %s", kernel_name)
+                else:
+                    self.log.debug("Kernelspec %s is already installed", kernel_name)
             else:
                 self.log.warning(
                     "Failed to install kernelspec, as there was no kernelspec to be installed."
                 )
 
     class LocalCloneHandler(CloneHandler):
-        def get(self):
-            path = self.get_query_argument("clone_from")
+        provider = "local"
+
+        async def clone(self):
+            path = self.option("clone_from")
+            clone_to = self.option("clone_to", default="/")
+            self.log.info("Cloning file at %s to %s", path, clone_to)
+
+            await self.clone_changed(path, clone_to)
+
+        def source_key(self, path):
+            return ("local", os.path.normpath(path))
+
+        def sync_key(self, path):
+            return os.path.normpath(path)
 
+        async def check_source(self, path, entry):
             try:
-                dirname = os.path.dirname(path)
-                with open(os.path.join(dirname, "kernel.json"), "r") as f:
-                    kerneljson = json.load(f)
-                kernelspec = json.dumps(kerneljson)
-                kernel_name = os.path.basename(dirname)
-                self.clone_kernelspec(kernelspec, kernel_name)
+                state = await run_blocking(file_state, path)
+            except FileNotFoundError:
+                raise web.HTTPError(400, "No such file: %s" % path)
+            if entry is not None and entry.get("state") == state:
+                return None
+            return {"state": state}, None
+
+        async def fetch_new_source(self, path, checked=None):
+            """Read the notebook at path, and the kernel.json in the same directory if there is one
+
+            Returns (notebook, kernelspec, kernel_name), where kernelspec is None if
+            there's no kernel.json.
+            """
+            dirname = os.path.dirname(path)
+            kernel_name = os.path.basename(dirname)
+            try:
+                with STAGE_SECONDS.labels("kernelspec_probe", "local").time():
+                    kerneljson = await run_blocking(
+                        read_json, os.path.join(dirname, "kernel.json")
+                    )
             except Exception as e:
-                self.log.warning("Failed to load kernel.json or to install kernelspec.")
+                if isinstance(e, FileNotFoundError):
+                    KERNELSPEC_MISSING.labels("local").inc()
+                self.log.warning("Failed to load kernel.json.")
                 self.log.error(e)
+                kernelspec = None
+            else:
+                kernelspec = json.dumps(kerneljson)
 
-            clone_to = self.get_query_argument("clone_to", default="/")
-            self.log.info("Cloning file at %s to %s", path, clone_to)
-            if not os.path.isfile(path):
+            if not await run_blocking(os.path.isfile, path):
                 raise web.HTTPError(400, "No such file: %s" % path)
-            with open(path, "r") as f:
-                nbjson = json.load(f)
-
-            # Turn JSON object into a string
-            nb = json.dumps(nbjson)
-            self.clone_to_directory(nb, path, clone_to)
+            with STAGE_SECONDS.labels("fetch", "local").time():
+                # Only its header is read, if it can be copied as it is
+                nb = await run_blocking(notebook_file, path) if fast_copy else None
+                if nb is None:
+                    nb = await run_blocking(read_bytes, path)
+            FETCHED_BYTES.labels("local").inc(
+                nb.size if isinstance(nb, NotebookFile) else len(nb)
+            )
+            return nb, kernelspec, kernel_name
 
     class URLCloneHandler(CloneHandler):
-        client = httpclient.AsyncHTTPClient()
+        # Shared by every clone, so they reuse each other's connections
+        client = make_client(clone_config)
 
-        async def get(self):
-            url = url_unescape(self.get_query_argument("clone_from"))
-            if not url.endswith(".ipynb"):
-                raise web.HTTPError(415)
+        async def clone(self):
+            # Already unescaped once, as the renderers escape it once
+            url = self.option("clone_from")
+            clone_to = self.option("clone_to", default="/")
+            self.provider = url_provider(url)
+            self.log.info("Cloning notebook from URL: %s", url)
+
+            await self.clone_changed(url, clone_to)
 
-            # Try to find kernelspec at designated source location
-            # This is the root of the git repository if notebook is on GitHub
+        def source_key(self, url):
+            # Everything fetch_new_source's result depends on
+            return (
+                self.remote_url(url),
+                self.option("kernelspec_source", default=None),
+                self.option("kernelspec_probes", default=None),
+                self.option("kernel_name", default=None),
+            )
+
+        def sync_key(self, url):
+            return self.remote_url(url)
+
+        async def check_source(self, url, entry):
+            """Fetch url with a conditional request if it was synced as entry"""
+            remote_url = self.remote_url(url)
+            headers = {}
+            if entry is not None:
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+            provider = url_provider(url)
             try:
-                kernelspec_source = self.get_query_argument("kernelspec_source")
-                kernelspec = await self.fetch_utf8_file(
-                    os.path.join(kernelspec_source, "kernel.json")
-                )
-            except Exception as e:
-                global_kernelspec_error = e
-            else:
-                global_kernelspec_error = None
+                with STAGE_SECONDS.labels("fetch", provider).time():
+                    response = await self.download(
+                        remote_url, provider, headers=headers
+                    )
+            except httpclient.HTTPError as e:
+                if e.code == 304 and headers:
+                    return None
+                raise
+            # For other clones of it to find
+            response_cache.add(remote_url, response)
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            return validators, response
+
+        async def fetch_new_source(self, url, checked=None):
+            """Fetch the notebook at url along with its kernelspec, if it has one
+
+            Returns (notebook, kernelspec, kernel_name), where kernelspec is None if
+            no kernel.json was found. checked is the response for url if it was
+            already downloaded by check_source, which is then used instead.
+            """
+            if not url.endswith(".ipynb"):
+                raise web.HTTPError(415)
 
-            # Try to find kernelspec in same directory as notebook
-            # If it exists, overwrite any existing kernelspec
+            # The designated kernelspec source is the root of the git repository if notebook is on GitHub
+            kernelspec_source = self.option("kernelspec_source", default=None)
             dirname = os.path.dirname(url)
+            probe_kernelspecs = clone_config.should_probe_kernelspecs(url)
+            # The renderers pass on which kernel.json files exist, if they already know
+            probes = self.option("kernelspec_probes", default="global,local").split(",")
+
+            # Fetch the notebook and both kernelspecs concurrently,
+            # so a clone costs one round-trip rather than three
             try:
-                kernelspec = await self.fetch_utf8_file(
-                    os.path.join(dirname, "kernel.json")
+                nb, global_probe, local_probe = await asyncio.wait_for(
+                    asyncio.gather(
+                        self.fetch_notebook(url, checked),
+                        self.probe_kernelspec(
+                            kernelspec_source, probe_kernelspecs and "global" in probes
+                        ),
+                        self.probe_kernelspec(
+                            dirname, probe_kernelspecs and "local" in probes
+                        ),
+                    ),
+                    timeout=clone_config.clone_deadline,
                 )
-            except Exception as e:
-                local_kernelspec_error = e
-            else:
-                local_kernelspec_error = None
+            except asyncio.TimeoutError:
+                raise web.HTTPError(504, "Timed out fetching %s" % url)
 
-            # If kernelspec can't be found at either location, report warning
-            if (
-                global_kernelspec_error is not None
-                and local_kernelspec_error is not None
-            ):
-                self.log.warning("Failed to load kernel.json")
-                self.log.warning(global_kernelspec_error)
-                self.log.warning(local_kernelspec_error)
+            global_kernelspec, global_kernelspec_error = global_probe
+            local_kernelspec, local_kernelspec_error = local_probe
+
+            # If it exists, the kernelspec in the same directory as the notebook
+            # overrides the one at the designated source location
+            if local_kernelspec_error is None:
+                kernelspec = local_kernelspec
+            elif global_kernelspec_error is None:
+                kernelspec = global_kernelspec
+            else:
+                # If kernelspec can't be found at either location, report warning
+                if probe_kernelspecs and any(probes):
+                    self.log.warning("Failed to load kernel.json")
+                    self.log.warning(global_kernelspec_error)
+                    self.log.warning(local_kernelspec_error)
                 kernelspec = None
 
             try:
-                kernel_name = self.get_query_argument("kernel_name")
+                kernel_name = self.option("kernel_name")
             except web.MissingArgumentError:
                 kernel_name = os.path.basename(dirname)
             else:
@@ -151,29 +775,104 @@ def load_jupyter_server_extension(nb_server_app):
                             dirname.replace("/", "_").replace(".", "_")
                         )
 
-            # Try to install the kernelspec, but even if this fails clone notebook anyway
+            return nb, kernelspec, kernel_name
+
+        async def probe_kernelspec(self, dirname, enabled=True):
+            """Fetch the kernel.json in dirname, if there is one
+
+            Kernelspecs are optional, so instead of raising this returns a
+            (kernelspec, error) pair with exactly one of the two set.
+            """
+            if not enabled:
+                return None, Exception("Kernelspec probes disabled for %s" % dirname)
+            if dirname is None:
+                return None, web.MissingArgumentError("kernelspec_source")
+            provider = url_provider(dirname)
             try:
-                self.clone_kernelspec(kernelspec, kernel_name)
+                with STAGE_SECONDS.labels("kernelspec_probe", provider).time():
+                    kernelspec = await self.fetch_utf8_file(
+                        os.path.join(dirname, "kernel.json"),
+                        request_timeout=clone_config.kernelspec_fetch_timeout,
+                    )
             except Exception as e:
-                self.log.warning("Failed to install kernelspec.")
-                self.log.warning(e)
-
-            clone_to = self.get_query_argument("clone_to", default="/")
-            self.log.info("Cloning notebook from URL: %s", url)
-            nb = await self.fetch_utf8_file(url)
+                if getattr(e, "code", None) == 404:
+                    KERNELSPEC_MISSING.labels(provider).inc()
+                return None, e
+            return kernelspec, None
 
-            self.clone_to_directory(nb, url, clone_to)
+        def source_name(self, clone_from):
+            # Escapes in the URL aren't part of the name
+            return unquote(os.path.basename(clone_from))
 
-        async def fetch_utf8_file(self, url):
+        def remote_url(self, url):
             try:
-                protocol = self.get_query_argument("protocol")
+                protocol = self.option("protocol")
             # Assume HTTPS and not HTTP by default:
             except web.MissingArgumentError:
                 protocol = "https"
 
-            remote_url = "{}://{}".format(protocol, url_escape(url, plus=False))
+            # Only escape what can't appear in a URL, so ports, query strings
+            # and escapes that are part of the URL are kept as they are
+            return "{}://{}".format(protocol, quote(url, safe=URL_SAFE))
+
+        async def fetch_notebook(self, url, response=None):
+            """Fetch the notebook at url, enforcing max_download_bytes, see response_notebook
+
+            With stream_downloads the body is collected chunk by chunk, and
+            spooled to a temp file past spool_bytes, instead of being buffered by the client.
+            If response is given, it's url's, and only read.
+            """
+            if response is None:
+                remote_url = self.remote_url(url)
+                provider = url_provider(url)
+                with STAGE_SECONDS.labels("fetch", provider).time():
+                    response = await response_cache.fetch(
+                        remote_url, partial(self.download, provider=provider)
+                    )
+            return await run_blocking(response_notebook, response)
+
+        async def download(self, remote_url, provider, **kwargs):
+            """Fetch a notebook from upstream, enforcing max_download_bytes, see fetch_notebook"""
+            body = StreamedBody(
+                remote_url,
+                max_bytes=clone_config.max_download_bytes,
+                spool_bytes=clone_config.spool_bytes,
+            )
+            if clone_config.stream_downloads:
+                kwargs["streaming_callback"] = body.streaming_callback
+            if self.job is not None:
+                # For the progress page to count the bytes received
+                self.job.downloads.append(body)
+            try:
+                response = await self.client.fetch(
+                    remote_url,
+                    header_callback=body.header_callback,
+                    request_timeout=clone_config.fetch_timeout,
+                    **kwargs
+                )
+            except Exception as e:
+                # The simple client aborts downloads over its max_body_size as a closed
+                # connection, the curl client with an error saying so
+                if body.too_large or "max_body_size" in str(e):
+                    raise DownloadTooLarge(remote_url, clone_config.max_download_bytes)
+                raise
+            if clone_config.stream_downloads:
+                body.finish(response)
+                FETCHED_BYTES.labels(provider).inc(body.size)
+            else:
+                FETCHED_BYTES.labels(provider).inc(len(response.body))
+            return response
+
+        async def fetch_utf8_file(self, url, request_timeout=None):
+            remote_url = self.remote_url(url)
 
-            response = await self.client.fetch(remote_url)
+            response = await response_cache.fetch(
+                remote_url,
+                partial(
+                    self.client.fetch,
+                    request_timeout=request_timeout or clone_config.fetch_timeout,
+                ),
+            )
 
             try:
                 utf8_file = response_text(response, encoding="utf-8")
@@ -182,15 +881,167 @@ def load_jupyter_server_extension(nb_server_app):
                 raise web.HTTPError(400)
             return utf8_file
 
+    class BulkCloneMixin:
+        """Clones several notebooks at once, e.g. all of those in a directory or GitHub tree
+
+        Sources are given by repeating the clone_from argument. They're fetched
+        concurrently by at most bulk_clone_workers at a time, each distinct kernelspec
+        is installed once, and the notebooks are saved in a single pass, in
+        directory_name under clone_to if that's given.
+        """
+
+        async def bulk_sources(self):
+            return self.options.get("clone_from", [])
+
+        async def clone(self):
+            sources = await self.bulk_sources()
+            if not sources:
+                raise web.HTTPError(400, "No notebooks to clone")
+            clone_to = self.option("clone_to", default="/")
+            directory_name = os.path.basename(self.option("directory_name", default=""))
+            self.log.info("Cloning %d notebooks to %s", len(sources), clone_to)
+            if self.job is not None:
+                self.job.notebooks = len(sources)
+            if directory_name:
+                clone_to = os.path.join(clone_to, directory_name)
+            await self.open_sync(clone_to)
+
+            workers = locks.Semaphore(clone_config.bulk_clone_workers)
+
+            async def fetch(source):
+                async with workers:
+                    fetched = await self.fetch_changed(source)
+                    if fetched is None:
+                        return None
+                    nb, kernelspec, kernel_name = fetched
+                    model = await self.notebook_model(nb, source)
+                if self.job is not None:
+                    self.job.fetched += 1
+                return model, kernelspec, kernel_name
+
+            results = await asyncio.gather(
+                *(fetch(source) for source in sources), return_exceptions=True
+            )
+
+            models = []
+            kernelspecs = {}
+            unchanged = 0
+            for source, result in zip(sources, results):
+                if isinstance(result, Exception):
+                    self.log.warning("Failed to clone %s: %s", source, result)
+                    if self.job is not None:
+                        # Listed on the progress page
+                        self.job.skip(source, result)
+                    continue
+                if result is None:
+                    unchanged += 1
+                    continue
+                model, kernelspec, kernel_name = result
+                models.append((source, model))
+                if kernelspec is not None:
+                    kernelspecs[kernel_name] = kernelspec
+            if unchanged:
+                self.log.info(
+                    "%d notebooks are unchanged since they were synced", unchanged
+                )
+                if not models:
+                    await self.save_sync_index()
+                    self.cloned(clone_to)
+                    return
+            if not models:
+                raise web.HTTPError(
+                    400, "None of the %d notebooks could be cloned" % len(sources)
+                )
+
+            for kernel_name, kernelspec in kernelspecs.items():
+                try:
+                    await self.clone_kernelspec(kernelspec, kernel_name)
+                except Exception as e:
+                    self.log.warning("Failed to install kernelspec %s.", kernel_name)
+                    self.log.warning(e)
+
+            if directory_name:
+                if not await run_blocking(contents_manager.dir_exists, clone_to):
+                    await run_blocking(
+                        contents_manager.save, {"type": "directory"}, clone_to
+                    )
+            await self.save_notebooks(models, clone_to)
+            self.cloned(clone_to)
+
+    class LocalBulkCloneHandler(BulkCloneMixin, LocalCloneHandler):
+        async def bulk_sources(self):
+            # A whole directory can be given instead of a list of notebooks
+            clone_from_dir = self.option("clone_from_dir", default=None)
+            if clone_from_dir is None:
+                return await super().bulk_sources()
+            try:
+                names = await run_blocking(os.listdir, clone_from_dir)
+            except OSError as e:
+                raise web.HTTPError(400, "Cannot list %s: %s" % (clone_from_dir, e))
+            return [
+                os.path.join(clone_from_dir, name)
+                for name in sorted(names)
+                if name.endswith(".ipynb")
+            ]
+
+    class URLBulkCloneHandler(BulkCloneMixin, URLCloneHandler):
+        async def bulk_sources(self):
+            urls = await super().bulk_sources()
+            if urls:
+                self.provider = url_provider(urls[0])
+            return urls
+
+    def job_for_user(handler, job_id):
+        """The clone job job_id, if it's handler's user's, raising 404 otherwise"""
+        job = clone_jobs.get(job_id)
+        if job is None or job.user != handler.current_user:
+            raise web.HTTPError(404, "No such clone job: %s" % job_id)
+        return job
+
+    class CloneJobHandler(IPythonHandler):
+        """The page that follows a clone job's progress, and opens the clone when it's done"""
+
+        @web.authenticated
+        def get(self, job_id):
+            job_for_user(self, job_id)
+            self.finish(
+                self.render_template(
+                    "clone_job.html",
+                    status_url=url_path_join(self.base_url, "api/clone_jobs", job_id),
+                )
+            )
+
+    class CloneJobAPIHandler(APIHandler):
+        """A clone job's progress, see CloneJob.status"""
+
+        @web.authenticated
+        def get(self, job_id):
+            job = job_for_user(self, job_id)
+            self.finish(json.dumps(job.status()))
+
+    # The progress page of clone jobs, after the notebook server's own templates
+    jinja_env = web_app.settings["jinja2_env"]
+    jinja_env.loader = ChoiceLoader(
+        [jinja_env.loader, FileSystemLoader(os.path.join(HERE, "templates"))]
+    )
+
     host_pattern = ".*$"
     base_url = web_app.settings["base_url"]
     url_route_pattern = url_path_join(base_url, "/url_clone")
     local_route_pattern = url_path_join(base_url, "/local_clone")
+    url_bulk_route_pattern = url_path_join(base_url, "/url_bulk_clone")
+    local_bulk_route_pattern = url_path_join(base_url, "/local_bulk_clone")
+    job_route_pattern = url_path_join(base_url, "/clone_jobs/([^/]+)")
+    job_api_route_pattern = url_path_join(base_url, "/api/clone_jobs/([^/]+)")
 
     web_app.add_handlers(
         host_pattern,
         [
             (url_route_pattern, URLCloneHandler),
             (local_route_pattern, LocalCloneHandler),
+            (url_bulk_route_pattern, URLBulkCloneHandler),
+            (local_bulk_route_pattern, LocalBulkCloneHandler),
+            (job_route_pattern, CloneJobHandler),
+            (job_api_route_pattern, CloneJobAPIHandler),
         ],
     )
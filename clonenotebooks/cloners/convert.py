@@ -0,0 +1,95 @@
+import json
+
+import nbformat
+
+
+def notebook_content(nb, strip_outputs=False, max_output_bytes=0):
+    """Return the v4 notebook content of nb, ready to go in a contents model
+
+    nb may be the notebook's JSON as str or bytes, or the already-parsed JSON object.
+    It is parsed at most once, and only notebooks older than v4 are converted,
+    since nbformat.reads(..., as_version=4) leaves v4 notebooks unchanged anyway.
+
+    With strip_outputs or max_output_bytes the outputs are reduced as it's read,
+    see reduce_outputs.
+    """
+    if isinstance(nb, (str, bytes)):
+        try:
+            nb = json.loads(nb)
+        except ValueError as e:
+            raise nbformat.reader.NotJSONError(
+                "Notebook does not appear to be JSON"
+            ) from e
+
+    if nb.get("nbformat") != 4:
+        nb = nbformat.convert(nbformat.from_dict(nb), 4)
+    if strip_outputs or max_output_bytes:
+        reduce_outputs(nb, strip_outputs, max_output_bytes)
+    return nb
+
+
+def json_size(value):
+    """Roughly the size in bytes of a JSON value in a notebook, without serializing it"""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, list):
+        return sum(json_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(len(key) + json_size(item) for key, item in value.items())
+    return 8
+
+
+def reduce_outputs(nb, strip_outputs=False, max_output_bytes=0):
+    """Drop the outputs of v4 notebook content nb, or those over max_output_bytes, in place
+
+    With strip_outputs, every output and execution count is dropped. Otherwise, with
+    max_output_bytes, stream outputs larger than that are truncated and larger
+    representations of other outputs are replaced by a note saying so. Cell attachments
+    and widget state larger than max_output_bytes (or any, with strip_outputs) are
+    dropped too.
+    """
+    limit = 0 if strip_outputs else max_output_bytes
+    widgets = nb.get("metadata", {}).get("widgets")
+    if widgets is not None and (strip_outputs or json_size(widgets) > limit):
+        del nb["metadata"]["widgets"]
+
+    for cell in nb.get("cells", []):
+        attachments = cell.get("attachments")
+        if attachments:
+            for name, bundle in list(attachments.items()):
+                if strip_outputs or json_size(bundle) > limit:
+                    del attachments[name]
+        if cell.get("cell_type") != "code":
+            continue
+        if strip_outputs:
+            cell["outputs"] = []
+            cell["execution_count"] = None
+        else:
+            cell["outputs"] = [
+                reduce_output(output, limit) for output in cell["outputs"]
+            ]
+
+
+def reduce_output(output, limit):
+    if output.get("output_type") == "stream":
+        text = output.get("text", "")
+        if isinstance(text, list):
+            text = "".join(text)
+        if len(text) > limit:
+            note = "\n[%d characters truncated when cloned]\n" % (len(text) - limit)
+            output["text"] = text[:limit] + note
+        return output
+
+    data = output.get("data")
+    if not data:
+        return output
+    sizes = {mimetype: json_size(value) for mimetype, value in data.items()}
+    removed = [mimetype for mimetype, size in sizes.items() if size > limit]
+    for mimetype in removed:
+        del data[mimetype]
+    if removed and "text/plain" not in data:
+        data["text/plain"] = "\n".join(
+            "[%s output of %d bytes removed when cloned]" % (mimetype, sizes[mimetype])
+            for mimetype in removed
+        )
+    return output
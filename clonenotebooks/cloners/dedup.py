@@ -0,0 +1,196 @@
+from hashlib import sha256
+import json
+import os
+from tempfile import mkstemp
+
+import nbformat
+
+from .fastcopy import copy_range
+from .sync import file_digest
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+# FICLONE from linux/fs.h: share the source's extents with the destination (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+LINK_MODES = ("reflink", "copy")
+
+
+def copy_state(st):
+    """What tells whether a stored copy changed, from its os.stat
+
+    Its mtime and size, and its ctime, which unlike the mtime its owner can't set back.
+    """
+    return (st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size)
+
+
+class DedupStore:
+    """Content-addressed store of cloned notebooks, shared by every user's server
+
+    v4 notebooks are kept once per version, under the SHA-256 of the notebook as it was
+    fetched, and each clone is made from the stored copy instead of being serialized
+    again. With link_mode "reflink" the clone shares the stored copy's blocks until
+    either is changed, on filesystems that support it, and otherwise it's copied,
+    which is all "copy" does.
+
+    The store has to be writable by every user, so nothing in it is trusted: a stored
+    copy is only reused once it's been checked to have the digest it's named after,
+    and only while it hasn't changed since (see copy_state), as whoever stored it owns
+    it. Each copy is checked once, by each server, or not at all by the server that
+    stored it. Stored copies are created read-only, and with the sticky bit on the
+    store's directories (as on /tmp, and as the ones it creates get) users can't replace
+    each other's. It has to be on the same filesystem as the home directories for
+    reflinks to work.
+    """
+
+    def __init__(self, root, link_mode="reflink"):
+        if link_mode not in LINK_MODES:
+            raise ValueError("Unknown link mode %r" % link_mode)
+        self.root = root
+        self.link_mode = link_mode
+        # The copy_state of each stored copy when it last had its digest: {digest: state}
+        self.checked = {}
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".ipynb")
+
+    def stored(self, digest):
+        """Whether a stored copy of digest is there, and is what it's named after
+
+        It's only read if it wasn't checked before, or changed since.
+        """
+        path = self.path(digest)
+        try:
+            state = copy_state(os.stat(path))
+            if self.checked.get(digest) == state:
+                return True
+            if file_digest(path) != digest or copy_state(os.stat(path)) != state:
+                return False
+        except FileNotFoundError:
+            return False
+        self.checked[digest] = state
+        return True
+
+    def make_directory(self, directory):
+        """Create directory in the store, writable by every user but with the sticky bit"""
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            return
+        # Rather than mkdir's mode, which the umask applies to
+        os.chmod(directory, 0o1777)
+
+    def add(self, data):
+        """Store notebook data (its JSON as bytes) unless it's stored already, and return its digest
+
+        Returns None if it isn't a v4 notebook, which are the only ones stored, or if a
+        stored copy that doesn't match its digest can't be replaced. Raises the same
+        NotJSONError if data isn't JSON.
+        """
+        digest = sha256(data).hexdigest()
+        path = self.path(digest)
+        if self.stored(digest):
+            return digest
+
+        os.makedirs(self.root, exist_ok=True)
+        directory = os.path.dirname(path)
+        self.make_directory(directory)
+        fd, temp = mkstemp(dir=directory, prefix=".notebook-")
+        # Readable by the other clones that wait for it, and locked until it's stored
+        os.fchmod(fd, 0o444)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        claim = os.path.join(directory, "." + digest + ".writing")
+        try:
+            # Only claimed once it's locked, so whoever finds the claim can wait on it
+            os.link(temp, claim)
+        except FileExistsError:
+            # Another clone is storing it already, e.g. when a whole tutorial clones
+            # the same notebook at once, so wait for that instead of writing it again
+            if self.wait_for(path, claim) and self.stored(digest):
+                os.close(fd)
+                os.unlink(temp)
+                return digest
+            claim = temp
+        except OSError:
+            # Without hard links, it's stored without claiming it
+            claim = temp
+        else:
+            os.unlink(temp)
+
+        try:
+            try:
+                nb = json.loads(data)
+            except ValueError as e:
+                raise nbformat.reader.NotJSONError(
+                    "Notebook does not appear to be JSON"
+                ) from e
+            if not isinstance(nb, dict) or nb.get("nbformat") != 4:
+                # Converted (or refused) when it's parsed, so it wouldn't match its digest
+                os.close(fd)
+                os.unlink(claim)
+                return None
+
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.replace(claim, path)
+                # Checked as it's written, and still locked
+                self.checked[digest] = copy_state(os.fstat(f.fileno()))
+        except PermissionError:
+            # Someone else's copy, which doesn't match, in a directory with the sticky bit
+            os.unlink(claim)
+            return None
+        except BaseException:
+            os.unlink(claim)
+            raise
+        return digest
+
+    def wait_for(self, path, claim):
+        """Wait for whoever holds claim to store path, returning whether they did
+
+        They keep it locked until then, and the lock goes with them if they die first.
+        """
+        try:
+            fd = os.open(claim, os.O_RDONLY)
+        except FileNotFoundError:
+            # Stored, or they gave up, most likely because it isn't a valid notebook
+            return os.path.isfile(path)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+        finally:
+            os.close(fd)
+        return os.path.isfile(path)
+
+    def clone(self, digest, destination, data):
+        """Create destination from the stored notebook, returning how it was done
+
+        destination mustn't exist yet. If the stored copy changed since stored() checked
+        it, the clone is written from data instead.
+        """
+        source = self.path(digest)
+        with open(source, "rb") as src, open(destination, "xb") as dst:
+            state = copy_state(os.fstat(src.fileno()))
+            method = None
+            if self.link_mode == "reflink" and fcntl is not None:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    method = "reflink"
+                except OSError:
+                    pass
+            if method is None:
+                method = copy_range(src, dst)
+            # The copy stored() checked, and not changed while it was being cloned
+            unchanged = (
+                self.checked.get(digest) == state == copy_state(os.fstat(src.fileno()))
+            )
+
+        if not unchanged:
+            with open(destination, "wb") as f:
+                f.write(data)
+            method = "write"
+        return method
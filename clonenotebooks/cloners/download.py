@@ -0,0 +1,125 @@
+from hashlib import sha256
+import io
+import json
+import os
+from io import BytesIO
+from tempfile import TemporaryFile
+
+from tornado import web
+
+
+class DownloadTooLarge(web.HTTPError):
+    def __init__(self, url, max_bytes):
+        super().__init__(
+            413, "%s is larger than the %d byte download limit", url, max_bytes
+        )
+
+
+class StreamedBody:
+    """Collects a response body from AsyncHTTPClient's streaming_callback
+
+    The body is kept in memory up to spool_bytes, then moved to a temp file
+    (0 keeps it in memory however large it gets). header_callback records the
+    Content-Length, so a download over max_bytes can be told apart from other
+    failures once the client has aborted it.
+    """
+
+    def __init__(self, url, max_bytes, spool_bytes=0):
+        self.url = url
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.content_length = None
+        self.size = 0
+        self.chunks = []
+        self.spool = None
+
+    @property
+    def too_large(self):
+        return max(self.size, self.content_length or 0) > self.max_bytes
+
+    def header_callback(self, line):
+        name, _, value = line.partition(":")
+        if line.startswith("HTTP/"):
+            # Start of a new response, e.g. after a redirect
+            self.content_length = None
+        elif name.strip().lower() == "content-length":
+            try:
+                self.content_length = int(value)
+            except ValueError:
+                pass
+
+    def streaming_callback(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            # Only reached with clients that don't enforce max_body_size themselves
+            raise DownloadTooLarge(self.url, self.max_bytes)
+        if self.spool is not None:
+            self.spool.write(chunk)
+            return
+        self.chunks.append(chunk)
+        if self.spool_bytes and self.size > self.spool_bytes:
+            self.spool = TemporaryFile(prefix="clonenotebooks-")
+            self.spool.writelines(self.chunks)
+            self.chunks = []
+
+    def finish(self, response):
+        """Put the collected body into response, or attach the temp file it was spooled to"""
+        if self.spool is not None:
+            self.spool.flush()
+            response.spool = self.spool
+        else:
+            response.buffer = BytesIO(b"".join(self.chunks))
+            self.chunks = []
+        return response
+
+
+class SpoolReader(io.RawIOBase):
+    """Reads a spooled body with os.pread, from its own offset, digesting it as it goes
+
+    So concurrent clones sharing one download can read it at the same time.
+    """
+
+    def __init__(self, spool):
+        self.fd = spool.fileno()
+        self.offset = 0
+        self.digest = sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = os.pread(self.fd, len(buffer), self.offset)
+        buffer[: len(data)] = data
+        self.offset += len(data)
+        self.digest.update(data)
+        return len(data)
+
+
+class SpooledNotebook(dict):
+    """A notebook parsed from a spooled body, with the SHA-256 of the body as sha256
+
+    The same digest as sync.text_digest of the body's text, had it been kept in memory.
+    """
+
+    sha256 = None
+
+
+def response_notebook(response):
+    """The notebook in the body of response, which has to be UTF-8
+
+    That's the body's text if it's in memory, or if it was spooled to a temp file a
+    SpooledNotebook parsed from that file as it's read, so its text isn't kept on the side.
+    """
+    spool = getattr(response, "spool", None)
+    try:
+        if spool is None:
+            return response.body.decode("utf-8")
+        reader = SpoolReader(spool)
+        with io.TextIOWrapper(io.BufferedReader(reader), encoding="utf-8") as f:
+            nb = SpooledNotebook(json.load(f))
+        nb.sha256 = reader.digest.hexdigest()
+        return nb
+    except UnicodeDecodeError:
+        raise web.HTTPError(400, "Notebook is not UTF-8: %s" % response.effective_url)
+    except ValueError as e:
+        raise web.HTTPError(400, "Not a valid notebook: %s" % e)
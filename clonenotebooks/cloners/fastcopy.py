@@ -0,0 +1,108 @@
+"""Local clones of v4 notebooks, copied byte for byte without being parsed
+
+nbformat, and so JupyterLab and the notebook server, write v4 notebooks with their keys
+sorted, which puts "cells" first and the "nbformat" and "nbformat_minor" version last.
+A local notebook whose first and last few bytes look like that is a v4 notebook that
+can be cloned as it is, so it's copied by the kernel (copy_file_range, or sendfile)
+rather than read, parsed, serialized and written back out. Anything else, e.g. an older
+notebook or one written by another tool, is cloned the usual way.
+"""
+from collections import namedtuple
+import os
+import re
+
+import nbformat
+
+# Enough for the start of the first cell, and the version at the end
+HEADER_BYTES = 64
+TRAILER_BYTES = 256
+
+HEADER = re.compile(rb'\A\s*\{\s*"cells"\s*:\s*\[')
+TRAILER = re.compile(
+    rb'"nbformat"\s*:\s*4\s*,\s*"nbformat_minor"\s*:\s*(\d+)\s*\}\s*\Z'
+)
+
+# How many bytes a copy_file_range or sendfile call is asked for at a time
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# A local notebook that's cloned by copying it, found by notebook_file
+NotebookFile = namedtuple("NotebookFile", ["path", "size"])
+
+
+def check_header(path):
+    """Return the size of the v4 notebook at path, or raise ValueError if it doesn't look like one
+
+    Only its first HEADER_BYTES and last TRAILER_BYTES are read.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(HEADER_BYTES)
+        f.seek(max(size - TRAILER_BYTES, 0))
+        tail = f.read()
+    if not HEADER.match(head):
+        raise ValueError("Notebook doesn't start with its cells")
+    match = TRAILER.search(tail)
+    if match is None:
+        raise ValueError("Notebook doesn't end with its nbformat 4 version")
+    if int(match.group(1)) > nbformat.v4.nbformat_minor:
+        raise ValueError(
+            "Notebook is newer than nbformat 4.%d" % nbformat.v4.nbformat_minor
+        )
+    return size
+
+
+def notebook_file(path):
+    """A NotebookFile for path if it can be cloned by copying it, otherwise None"""
+    try:
+        return NotebookFile(path, check_header(path))
+    except ValueError:
+        return None
+
+
+def copy_range(src, dst):
+    """Copy the open file src into the open file dst, returning how it was done"""
+    if hasattr(os, "copy_file_range"):
+        try:
+            # Within the filesystem where it can, e.g. a reflink or an NFS server-side copy
+            while os.copy_file_range(src.fileno(), dst.fileno(), CHUNK_BYTES):
+                pass
+            return "copy_file_range"
+        except OSError:
+            # e.g. across filesystems on older kernels, start over
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+    if hasattr(os, "sendfile"):
+        offset = 0
+        while True:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, CHUNK_BYTES)
+            if not sent:
+                break
+            offset += sent
+        return "sendfile"
+    while True:
+        chunk = src.read(1024 * 1024)
+        if not chunk:
+            break
+        dst.write(chunk)
+    return "copy"
+
+
+def copy_notebook(source, destination):
+    """Copy the notebook file source as destination, returning how it was done
+
+    destination mustn't exist yet. The copy's header is checked again, in case source
+    changed since it was, and removed if it no longer looks like a notebook.
+    """
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        try:
+            method = copy_range(src, dst)
+        except BaseException:
+            os.unlink(destination)
+            raise
+    try:
+        check_header(destination)
+    except ValueError:
+        os.unlink(destination)
+        raise ValueError("%s changed while it was being cloned" % source)
+    return method
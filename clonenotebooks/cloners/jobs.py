@@ -0,0 +1,148 @@
+"""Clones run in the background, for browsers to follow on a progress page
+
+A clone request with a `job` argument is queued, and answered straight away with a
+redirect to /clone_jobs/<id>, a page that polls /api/clone_jobs/<id> for the clone's
+progress and forwards to JupyterLab once it's done. That way large notebooks and bulk
+clones don't leave a browser tab (or the proxies in front of the server) waiting on a
+single request until they time out.
+"""
+import secrets
+import time
+
+from tornado import httpclient, queues, web
+from tornado.ioloop import IOLoop
+
+
+class CloneJob:
+    """A queued clone, and how far along it is
+
+    state goes from "queued" to "running" to "done" or "failed". stage is the stage
+    of the clone that's in progress, named as in clonenotebooks_stage_duration_seconds.
+    """
+
+    def __init__(self, user=None, options=None):
+        self.id = secrets.token_urlsafe(12)
+        # Who asked for the clone, and its arguments: the request that queued it
+        # is long finished by the time it runs
+        self.user = user
+        self.options = options or {}
+        self.state = "queued"
+        self.stage = None
+        # StreamedBody of each notebook download, which count the bytes received so far
+        self.downloads = []
+        # For bulk clones, along with the sources that couldn't be cloned and why
+        self.notebooks = 1
+        self.fetched = 0
+        self.skipped = []
+        # Where the clone can be opened, once it's done
+        self.url = None
+        self.error = None
+        self.created = time.monotonic()
+        self.finished = None
+
+    def finish(self, url):
+        self.state = "done"
+        self.stage = None
+        self.url = url
+        self.finished = time.monotonic()
+
+    def fail(self, error):
+        self.state = "failed"
+        self.error = error_message(error)
+        self.finished = time.monotonic()
+
+    def skip(self, source, error):
+        """Record that source was left out of a bulk clone because of error"""
+        self.skipped.append({"source": source, "error": error_message(error)})
+
+    def status(self):
+        """The job's progress, as sent to the progress page"""
+        content_lengths = [download.content_length for download in self.downloads]
+        if not content_lengths or None in content_lengths:
+            # Only known if every download has a Content-Length
+            total_bytes = None
+        else:
+            total_bytes = sum(content_lengths)
+        return {
+            "id": self.id,
+            "state": self.state,
+            "stage": self.stage,
+            "bytes_fetched": sum(download.size for download in self.downloads),
+            "total_bytes": total_bytes,
+            "notebooks": self.notebooks,
+            "fetched": self.fetched,
+            "skipped": self.skipped,
+            "url": self.url,
+            "error": self.error,
+            "elapsed": (self.finished or time.monotonic()) - self.created,
+        }
+
+
+def error_message(error):
+    """What to tell the user about error"""
+    if isinstance(error, web.HTTPError):
+        message = error.log_message
+        if message and error.args:
+            message = message % error.args
+        return message or error.reason or "HTTP %d" % error.status_code
+    return str(error) or type(error).__name__
+
+
+class JobQueue:
+    """Runs queued clones, at most `workers` at a time, and keeps their jobs around
+
+    Finished jobs are forgotten after `ttl` seconds.
+    """
+
+    def __init__(self, workers=4, ttl=600, log=None):
+        self.workers = workers
+        self.ttl = ttl
+        self.log = log
+        self.jobs = {}
+        self._queue = queues.Queue()
+        self._started = False
+
+    def submit(self, run, user=None, options=None):
+        """Queue run(job) for a new job of user's with options, and return the job"""
+        self.prune()
+        job = CloneJob(user, options)
+        self.jobs[job.id] = job
+        self._queue.put_nowait((job, run))
+        if not self._started:
+            self._started = True
+            for _ in range(self.workers):
+                IOLoop.current().spawn_callback(self.work)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def prune(self):
+        now = time.monotonic()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished is not None and job.finished + self.ttl < now:
+                del self.jobs[job_id]
+
+    async def work(self):
+        while True:
+            job, run = await self._queue.get()
+            job.state = "running"
+            try:
+                await run(job)
+            except Exception as e:
+                job.fail(e)
+                if self.log is not None:
+                    self.log.warning(
+                        "Clone job %s failed: %s",
+                        job.id,
+                        job.error,
+                        # Expected failures, such as a notebook that isn't there
+                        exc_info=not isinstance(
+                            e, (web.HTTPError, httpclient.HTTPClientError)
+                        ),
+                    )
+            else:
+                if job.state == "running":
+                    job.fail(RuntimeError("The clone finished without a result"))
+            finally:
+                self._queue.task_done()
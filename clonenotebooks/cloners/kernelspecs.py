@@ -0,0 +1,74 @@
+from hashlib import sha256
+import os
+import re
+from tempfile import mkstemp
+import threading
+
+# Same rule as jupyter_client.kernelspec uses for kernel names
+kernel_name_pattern = re.compile(r"^[a-z0-9._\-]+$", re.IGNORECASE)
+
+
+class KernelspecInstaller:
+    """Installs cloned kernelspecs into the user's kernel directory, skipping unchanged ones
+
+    A kernelspec is compared by the SHA-256 of its kernel.json with what's already
+    installed under the same name, so cloning a whole repository only writes its
+    kernelspec once. Hashes of installed kernelspecs are remembered along with the
+    size and mtime of their kernel.json, so unchanged kernelspecs cost a single stat.
+    Changed kernelspecs are replaced atomically.
+    """
+
+    def __init__(self, kernel_dir):
+        self.kernel_dir = kernel_dir
+        # kernel name -> (digest, (mtime_ns, size)) of its installed kernel.json
+        self._installed = {}
+        self._lock = threading.Lock()
+
+    def install(self, kernelspec, kernel_name):
+        """Install kernelspec (the text of a kernel.json) as kernel_name
+
+        Returns False if it was already installed, True if it was written.
+        """
+        kernel_name = kernel_name.lower()
+        if not kernel_name_pattern.match(kernel_name):
+            raise ValueError("Invalid kernel name %r" % kernel_name)
+
+        content = kernelspec.encode("utf-8")
+        digest = sha256(content).hexdigest()
+        destination = os.path.join(self.kernel_dir, kernel_name)
+        path = os.path.join(destination, "kernel.json")
+
+        with self._lock:
+            if self.installed_digest(kernel_name, path) == digest:
+                return False
+
+            os.makedirs(destination, exist_ok=True)
+            fd, tmp_path = mkstemp(dir=destination, prefix=".kernel.json-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(content)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._installed[kernel_name] = (digest, stat_key(path))
+        return True
+
+    def installed_digest(self, kernel_name, path):
+        try:
+            key = stat_key(path)
+        except FileNotFoundError:
+            return None
+        known = self._installed.get(kernel_name)
+        if known is not None and known[1] == key:
+            return known[0]
+        with open(path, "rb") as f:
+            digest = sha256(f.read()).hexdigest()
+        self._installed[kernel_name] = (digest, key)
+        return digest
+
+
+def stat_key(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
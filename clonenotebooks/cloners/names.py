@@ -0,0 +1,40 @@
+import os
+import re
+
+
+def next_free_name(filename, taken, insert=""):
+    """The name ContentsManager.increment_filename would pick, given the names already taken
+
+    taken is the set of names in the destination directory, from a single listing, so
+    finding e.g. name-Copy100.ipynb doesn't take a hundred exists() calls.
+    """
+    # Same split into base name and (possibly multi-part) suffix as increment_filename
+    basename, dot, ext = filename.rpartition(".")
+    if ext != "ipynb":
+        basename, dot, ext = filename.partition(".")
+    suffix = dot + ext
+
+    name = basename + suffix
+    if name not in taken:
+        return name
+
+    pattern = re.compile(
+        re.escape(basename + insert) + r"([1-9][0-9]*)" + re.escape(suffix) + "$"
+    )
+    used = set()
+    for name in taken:
+        match = pattern.match(name)
+        if match:
+            used.add(int(match.group(1)))
+    i = 1
+    while i in used:
+        i += 1
+    return "{}{}{}{}".format(basename, insert, i, suffix)
+
+
+def create_new(path):
+    """Create an empty file at path, raising FileExistsError if there's anything there already
+
+    Claims a file name against anything else creating files in the same directory.
+    """
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
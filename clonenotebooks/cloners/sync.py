@@ -0,0 +1,128 @@
+"""Syncs, i.e. clones that only write the notebooks that changed since they were last cloned
+
+A sync keeps an index of what it cloned into a directory in a hidden file there. A
+later sync into the same directory asks upstream whether each notebook changed (with
+a conditional request, or by the mtime and size of a local file), and leaves the ones
+that didn't alone. How changed ones are written depends on the policy:
+
+- "replace" overwrites the earlier clone, unless it was edited since, in which case
+  the new version is saved next to it as with any other clone
+- "copy" always saves the new version next to the earlier clone
+"""
+from datetime import datetime, timezone
+from hashlib import sha256
+import json
+import os
+from tempfile import NamedTemporaryFile
+
+SYNC_POLICIES = ("replace", "copy")
+
+INDEX_NAME = ".clonenotebooks-sync.json"
+
+
+def text_digest(nb):
+    """The digest of a notebook's text (or bytes) a sync compares versions by
+
+    That's the SHA-256 of the notebook as it was fetched or read, see also
+    file_digest and download.SpooledNotebook.
+    """
+    if isinstance(nb, str):
+        nb = nb.encode("utf-8")
+    return sha256(nb).hexdigest()
+
+
+def file_digest(path):
+    """text_digest of the file at path, read a chunk at a time"""
+    digest = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_state(path):
+    """What tells whether the file at path changed: its mtime and size"""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class SyncIndex:
+    """The index of the notebooks synced into directory, kept in INDEX_NAME there
+
+    sources maps the key of each source (its URL or path) to an entry with the name
+    it was saved as ("name"), the state of the saved file right after it was saved
+    ("saved"), when that was ("synced"), the digest of that version ("sha256"), and
+    what upstream can tell whether it changed by: "etag" and "last_modified" for
+    URLs, "state" for local files.
+
+    The methods read and write files, so they're run on the clone executor.
+    """
+
+    def __init__(self, directory, sources=None):
+        self.directory = directory
+        self.sources = sources or {}
+        # Keys of the entries that changed since the index was loaded
+        self.updated = set()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, INDEX_NAME)
+
+    @classmethod
+    def load(cls, directory, log=None):
+        index = cls(directory)
+        try:
+            with open(index.path) as f:
+                index.sources = json.load(f)["sources"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            # Started over rather than failing every sync into this directory
+            if log is not None:
+                log.warning("Ignoring unreadable sync index %s: %s", index.path, e)
+        return index
+
+    def entry(self, key):
+        """The entry for key, if the file it was saved as is still there"""
+        entry = self.sources.get(key)
+        if entry is None or not os.path.isfile(self.saved_path(entry)):
+            return None
+        return entry
+
+    def saved_path(self, entry):
+        return os.path.join(self.directory, entry["name"])
+
+    def unedited(self, entry):
+        """Whether the file entry was saved as hasn't changed since"""
+        try:
+            return file_state(self.saved_path(entry)) == entry.get("saved")
+        except OSError:
+            return False
+
+    def update(self, key, **fields):
+        """Update key's entry, e.g. with new validators for the same version"""
+        self.sources[key] = dict(self.sources.get(key, {}), **fields)
+        self.updated.add(key)
+
+    def record(self, key, name, validators):
+        """Record that key was just saved as name, along with its validators"""
+        entry = dict(validators, name=name)
+        entry["saved"] = file_state(os.path.join(self.directory, name))
+        entry["synced"] = datetime.now(timezone.utc).isoformat()
+        self.sources[key] = entry
+        self.updated.add(key)
+
+    def save(self):
+        """Write the updated entries into the index, keeping those of concurrent syncs"""
+        if not self.updated:
+            return
+        current = SyncIndex.load(self.directory)
+        for key in self.updated:
+            current.sources[key] = self.sources[key]
+        with NamedTemporaryFile(
+            "w", dir=self.directory, prefix=INDEX_NAME, delete=False
+        ) as f:
+            json.dump({"version": 1, "sources": current.sources}, f, indent=1)
+        os.replace(f.name, self.path)
+        self.sources = current.sources
+        self.updated.clear()
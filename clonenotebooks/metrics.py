@@ -0,0 +1,71 @@
+"""Prometheus metrics shared by the cloners and the renderers
+
+Both register with prometheus_client's default registry, so the notebook server
+exports the cloner's metrics on its own /metrics endpoint, and nbviewer exports the
+renderers' through clonenotebooks.renderers.metrics.
+"""
+import re
+
+from prometheus_client import Counter, Histogram
+
+STAGE_SECONDS = Histogram(
+    "clonenotebooks_stage_duration_seconds",
+    "Time spent in each stage of a clone",
+    ["stage", "provider"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+CACHE_REQUESTS = Counter(
+    "clonenotebooks_cache_requests_total",
+    "Upstream fetches by how the response cache answered them",
+    ["result"],
+)
+
+KERNELSPEC_MISSING = Counter(
+    "clonenotebooks_kernelspec_missing_total",
+    "kernel.json probes that found nothing (404)",
+    ["provider"],
+)
+
+FETCHED_BYTES = Counter(
+    "clonenotebooks_fetched_bytes_total",
+    "Bytes of notebooks read from upstream or from the local filesystem",
+    ["provider"],
+)
+
+CLONE_ERRORS = Counter(
+    "clonenotebooks_errors_total",
+    "Clone requests that failed, by HTTP status code",
+    ["provider", "code"],
+)
+
+COALESCED_REQUESTS = Counter(
+    "clonenotebooks_coalesced_requests_total",
+    "Requests that waited for an identical one already in progress instead of repeating its work",
+    ["kind"],
+)
+
+CACHE_WARMS = Counter(
+    "clonenotebooks_cache_warms_total",
+    "Pages and kernelspec locations requested by the renderers' cache warmer",
+    ["kind", "result"],
+)
+
+DIRECTORY_LISTINGS = Counter(
+    "clonenotebooks_directory_listings_total",
+    "Local directory listings by whether they were answered by the listing cache or scanned",
+    ["result"],
+)
+
+# Raw URLs (without protocol) of the notebook hosts the renderers clone from
+GITHUB_HOSTS = re.compile(r"^(raw\.githubusercontent\.com|[^/]+/[^/]+/[^/]+/raw)/")
+GIST_HOSTS = re.compile(r"^gist\.githubusercontent\.com/")
+
+
+def url_provider(url):
+    """The provider label for a notebook URL (without protocol) passed to the cloner"""
+    if GIST_HOSTS.match(url):
+        return "gist"
+    if GITHUB_HOSTS.match(url):
+        return "github"
+    return "url"
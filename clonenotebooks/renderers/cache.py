@@ -0,0 +1,187 @@
+"""A cache for nbviewer kept in files, so that several nbviewer processes can share it
+
+nbviewer's own in-memory cache is per process, so with several workers (see
+clonenotebooks.workers) each of them would render a notebook before it's cached for
+all of them, and the lazily loaded parts of a notebook (clonenotebooks.renderers.lazy)
+could be asked for from a worker that never saw them. FileCache has the interface of
+nbviewer's caches instead, and keeps entries in a directory every worker can reach.
+
+Entries are pickled, and nbviewer unpickles the pages it caches too, so anyone who can
+write to the directory can run code in the workers. FileCache refuses directories that
+anyone but nbviewer's user could write to, see check_private.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from hashlib import sha1
+import os
+import pickle
+import struct
+from tempfile import NamedTemporaryFile
+import threading
+import time
+
+from tornado.ioloop import IOLoop
+
+from ..utils import check_private
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+# Each entry starts with the time it expires at, 0 for never, so that prune can
+# tell whether it did without reading the rest
+DEADLINE = struct.Struct("!d")
+
+# memcached's convention: larger expiry times are absolute, as lazy.py gives them
+RELATIVE_EXPIRY_MAX = 30 * 24 * 3600
+
+
+class FileCache:
+    """nbviewer's cache, in directory, holding at most max_bytes
+
+    Values are pickled, so they can be bytes as nbviewer's pages are, or the counts
+    of its rate limiter. Files are read and written on their own threads. Once in
+    every prune_interval seconds, a set removes the expired entries, and then the
+    least recently written until they're under max_bytes again.
+
+    Raises PermissionError if directory isn't private to this user, see check_private.
+    """
+
+    def __init__(
+        self, directory, max_bytes=1024 * 1024 * 1024, workers=4, prune_interval=60
+    ):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        check_private(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self._next_prune = time.monotonic() + prune_interval
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="filecache")
+        # add and incr read and write an entry under it, along with the other workers'
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        digest = sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def run(self, func, *args):
+        return IOLoop.current().run_in_executor(self._executor, partial(func, *args))
+
+    def get(self, key):
+        return self.run(self._get, key)
+
+    def set(self, key, value, expires=0, **kwargs):
+        return self.run(self._set, key, value, expires)
+
+    def add(self, key, value, expires=0, **kwargs):
+        return self.run(self._add, key, value, expires)
+
+    def incr(self, key):
+        return self.run(self._incr, key)
+
+    def _get(self, key):
+        entry = self._read(key)
+        return entry[1] if entry is not None else None
+
+    def _read(self, key):
+        """The (deadline, value) of key's entry, or None if there's none that's unexpired"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                [deadline] = DEADLINE.unpack(f.read(DEADLINE.size))
+                if deadline and deadline < time.time():
+                    os.remove(path)
+                    return None
+                return deadline, pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (struct.error, pickle.UnpicklingError, EOFError, ValueError):
+            # Written by something else, or cut short by a full disk
+            return None
+
+    def _set(self, key, value, expires):
+        if expires <= 0:
+            deadline = 0
+        elif expires > RELATIVE_EXPIRY_MAX:
+            deadline = expires
+        else:
+            deadline = time.time() + expires
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with NamedTemporaryFile(
+            "wb", dir=os.path.dirname(path), prefix=".entry-", delete=False
+        ) as f:
+            f.write(DEADLINE.pack(deadline))
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+
+        if time.monotonic() > self._next_prune:
+            self._next_prune = time.monotonic() + self.prune_interval
+            self.prune()
+        return True
+
+    def _add(self, key, value, expires):
+        with self.locked():
+            if self._get(key) is not None:
+                return False
+            return self._set(key, value, expires)
+
+    def _incr(self, key):
+        with self.locked():
+            entry = self._read(key)
+            if entry is None:
+                return None
+            deadline, value = entry
+            # Expires when it was going to
+            self._set(key, value + 1, deadline)
+            return value + 1
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, ".lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def prune(self):
+        """Remove expired entries, and the least recently written ones over max_bytes"""
+        now = time.time()
+        entries = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat()
+                    if entry.name.startswith("."):
+                        # Being written, unless it was left behind by a crash
+                        if st.st_mtime < now - 3600:
+                            os.remove(entry.path)
+                        continue
+                    with open(entry.path, "rb") as f:
+                        [deadline] = DEADLINE.unpack(f.read(DEADLINE.size))
+                    if deadline and deadline < now:
+                        os.remove(entry.path)
+                        continue
+                except (OSError, struct.error):
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,179 @@
+"""Lazy rendering of very large notebooks, and an nbviewer provider serving their deferred parts
+
+With the "lazy_render_cells" handler setting, a notebook with more cells than that is sent
+with only its first lazy_render_cells cells. The rest follow in sections of as many cells,
+loaded by static/clonenotebooks/lazy.js as the reader scrolls down to them. Images embedded
+in its outputs that are larger than "lazy_output_bytes" are loaded as they're scrolled to too.
+
+The deferred parts are kept in nbviewer's cache, and served on /clonenotebooks/lazy/<key>
+by this module, once it's added to nbviewer's providers in nbviewer_config.py:
+
+    from nbviewer.providers import default_providers
+    c.NBViewer.providers = default_providers + ["clonenotebooks.renderers.lazy"]
+"""
+from base64 import b64decode
+from hashlib import sha1
+from html.parser import HTMLParser
+import pickle
+import re
+import time
+
+from tornado import web
+
+from nbviewer.providers.base import BaseHandler
+from nbviewer.utils import url_path_join
+
+CACHE_KEY_PREFIX = "clonenotebooks-lazy-"
+
+# Images embedded in outputs by nbconvert
+DATA_URI = re.compile(
+    r'src="data:(?P<type>image/[\w.+-]+);base64,(?P<data>[A-Za-z0-9+/=\s]+)"'
+)
+
+VOID_ELEMENTS = frozenset(
+    "area base br col embed hr img input link meta param source track wbr".split()
+)
+
+# What a section that's yet to be loaded looks like until then
+PLACEHOLDER = """<div class="clonenotebooks-lazy" data-src="{url}">
+  <a href="{url}">Loading more cells&hellip;</a>
+</div>"""
+
+
+class TopLevelElements(HTMLParser):
+    """Finds where each top-level element of an HTML fragment starts, and its class
+
+    broken is set if the fragment has text outside of any element, or more
+    end tags than start tags, in which case it can't be split into elements.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.depth = 0
+        self.elements = []
+        self.broken = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.depth == 0:
+            self.elements.append((self.getpos(), dict(attrs).get("class") or ""))
+        if tag not in VOID_ELEMENTS:
+            self.depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if self.depth == 0:
+            self.elements.append((self.getpos(), dict(attrs).get("class") or ""))
+
+    def handle_endtag(self, tag):
+        if tag not in VOID_ELEMENTS:
+            self.depth -= 1
+            if self.depth < 0:
+                self.broken = True
+
+    def handle_data(self, data):
+        if self.depth == 0 and data.strip():
+            self.broken = True
+
+
+def is_cell(classes):
+    classes = classes.split()
+    return "cell" in classes or "jp-Cell" in classes
+
+
+def split_sections(body, cells_per_section):
+    """Split the HTML of a notebook's cells into sections of cells_per_section cells
+
+    Returns None if body isn't a sequence of cells as nbconvert renders them,
+    which is left whole rather than risk splitting it in the middle of something.
+    """
+    parser = TopLevelElements()
+    parser.feed(body)
+    parser.close()
+    if parser.broken or parser.depth != 0:
+        return None
+
+    line_offsets = [0] + [match.end() for match in re.finditer("\n", body)]
+    starts = []
+    cells = 0
+    for (line, column), classes in parser.elements:
+        if is_cell(classes):
+            if cells and cells % cells_per_section == 0:
+                starts.append(line_offsets[line - 1] + column)
+            cells += 1
+    if not cells:
+        return None
+    bounds = [0] + starts + [len(body)]
+    return [body[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def defer_images(body, min_bytes, defer):
+    """Replace images embedded in body larger than min_bytes with ones loaded lazily
+
+    defer(content, content_type) returns the URL a deferred image is served on.
+    """
+
+    def replace(match):
+        data = match.group("data")
+        if len(data) < min_bytes * 4 // 3:
+            return match.group(0)
+        url = defer(b64decode(data), match.group("type"))
+        return 'src="{}" loading="lazy"'.format(url)
+
+    return DATA_URI.sub(replace, body)
+
+
+def lazy_body(body, cells_per_section, output_bytes, defer):
+    """body, with all but its first section of cells loaded lazily, see split_sections
+
+    Each section ends with the placeholder for the next one, so that they're
+    loaded in order as the page is scrolled.
+    """
+    body = defer_images(body, output_bytes, defer)
+    sections = split_sections(body, cells_per_section)
+    if sections is None or len(sections) < 2:
+        return body
+    placeholder = ""
+    for section in reversed(sections[1:]):
+        url = defer((section + placeholder).encode("utf-8"), "text/html; charset=UTF-8")
+        placeholder = PLACEHOLDER.format(url=url)
+    return sections[0] + placeholder
+
+
+def defer_content(handler, writes, content, content_type):
+    """Keep content in nbviewer's cache for a while, and return the URL it's served on
+
+    The cache write is added to writes, to be awaited before the page referring to
+    it is sent. Keys are digests of the content, so a part shared by several
+    notebooks, or renders of one notebook, is only kept once. They outlive the pages
+    that refer to them, which are cached for at most cache_expiry_max seconds.
+    """
+    key = sha1(content).hexdigest()
+    value = pickle.dumps(
+        {"headers": {"Content-Type": content_type}, "body": content},
+        pickle.HIGHEST_PROTOCOL,
+    )
+    expires = int(time.time() + 2 * handler.cache_expiry_max)
+    writes.append(handler.cache.set(CACHE_KEY_PREFIX + key, value, expires))
+    return url_path_join(handler.base_url, "clonenotebooks/lazy", key)
+
+
+class LazyContentHandler(BaseHandler):
+    """Serves the sections and outputs of notebooks that were deferred by lazy_body"""
+
+    async def get(self, key):
+        cached = await self.cache.get(CACHE_KEY_PREFIX + key)
+        if cached is None:
+            raise web.HTTPError(404, "Expired, reload the notebook")
+        content = pickle.loads(cached)
+        for name, value in content["headers"].items():
+            self.set_header(name, value)
+        # The key is a digest of the content, so it never changes
+        self.set_header("Cache-Control", "private, max-age=86400, immutable")
+        self.finish(content["body"])
+
+
+def default_handlers(handlers=[], **handler_names):
+    return [(r"/clonenotebooks/lazy/([0-9a-f]{40})", LazyContentHandler, {})] + handlers
+
+
+def uri_rewrites(rewrites=[]):
+    return rewrites
@@ -0,0 +1,122 @@
+"""Directory listings for LocalRenderingHandler, made off the event loop and cached
+
+Listing a directory takes a stat per entry, which on shared filesystems and directories
+with thousands of entries can take seconds. Listings are made by a pool of
+"dirview_workers" threads (4 by default) instead, so that nbviewer keeps serving everyone
+else meanwhile. They're kept for "dirview_cache_ttl" seconds (60 by default, 0 turns it
+off), or until the directory's mtime changes, i.e. until entries are added, removed or
+renamed. Concurrent requests for a directory that's being listed share its listing.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+import os
+import time
+
+from tornado import web
+from tornado.ioloop import IOLoop
+
+from ..metrics import DIRECTORY_LISTINGS
+from ..utils import SingleFlight
+
+# entries as scan_directory returns them, for the directory as it was at mtime
+Listing = namedtuple("Listing", ["mtime", "expires", "entries"])
+
+
+def scan_directory(fullpath, can_show):
+    """The entries of fullpath that dirview.html shows, as LocalFileHandler.show_dir finds them
+
+    Those are the directories, then the notebooks, each sorted by name, that can_show
+    allows. Their "url" is left out, as it depends on the path they're requested by.
+    os.scandir tells directories from files without a stat, so only the entries that
+    are shown are stat'ed.
+    """
+    dirs = []
+    ipynbs = []
+    try:
+        contents = list(os.scandir(fullpath))
+    except PermissionError:
+        # Can't list it, so don't give away its presence
+        raise web.HTTPError(404)
+
+    for entry in contents:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            continue
+        if not is_dir and not entry.name.endswith(".ipynb"):
+            continue
+        if not can_show(entry.path):
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            # Removed since it was listed
+            continue
+        modtime = datetime.fromtimestamp(st.st_mtime, timezone.utc).isoformat()
+        if is_dir:
+            dirs.append(
+                {"name": entry.name, "modtime": modtime, "class": "fa fa-folder-open"}
+            )
+        else:
+            ipynbs.append(
+                {"name": entry.name, "modtime": modtime, "class": "fa fa-book"}
+            )
+
+    dirs.sort(key=lambda e: e["name"])
+    ipynbs.sort(key=lambda e: e["name"])
+    return dirs + ipynbs
+
+
+class DirectoryListings:
+    """Process-wide cache of directory listings, keyed by the directory's full path
+
+    At most max_entries listings are kept, the least recently made are dropped first.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._listings = {}
+        self._flights = SingleFlight()
+        self._executor = None
+
+    def run(self, func, *args, workers=4):
+        """Run func(*args) in the listing threads, which are started on first use"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix="dirview")
+        return IOLoop.current().run_in_executor(self._executor, partial(func, *args))
+
+    async def entries(self, fullpath, can_show, ttl=60, workers=4):
+        """The entries of fullpath, see scan_directory, from the cache if it's still up to date"""
+        listing = self._listings.get(fullpath)
+        if listing is not None and time.monotonic() < listing.expires:
+            try:
+                st = await self.run(os.stat, fullpath, workers=workers)
+            except OSError:
+                st = None
+            if st is not None and st.st_mtime_ns == listing.mtime:
+                DIRECTORY_LISTINGS.labels("hit").inc()
+                return listing.entries
+
+        DIRECTORY_LISTINGS.labels("scan").inc()
+        return await self._flights.run(
+            fullpath, partial(self.scan, fullpath, can_show, ttl, workers)
+        )
+
+    async def scan(self, fullpath, can_show, ttl, workers):
+        def stat_and_scan():
+            # Before scanning, so that a change during the scan makes it out of date
+            mtime = os.stat(fullpath).st_mtime_ns
+            return mtime, scan_directory(fullpath, can_show)
+
+        mtime, entries = await self.run(stat_and_scan, workers=workers)
+        if ttl > 0:
+            self._listings.pop(fullpath, None)
+            if len(self._listings) >= self.max_entries:
+                del self._listings[next(iter(self._listings))]
+            self._listings[fullpath] = Listing(mtime, time.monotonic() + ttl, entries)
+        return entries
+
+
+directory_listings = DirectoryListings()
@@ -0,0 +1,43 @@
+"""An nbviewer provider serving the renderers' Prometheus metrics on /metrics
+
+Add it to nbviewer's providers in nbviewer_config.py:
+
+    from nbviewer.providers import default_providers
+    c.NBViewer.providers = default_providers + ["clonenotebooks.renderers.metrics"]
+
+With several nbviewer workers (see clonenotebooks.workers), each of them keeps its
+metrics in PROMETHEUS_MULTIPROC_DIR, and whichever is asked serves the sum of them all.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+)
+from tornado import web
+
+
+def registry():
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+class MetricsHandler(web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest(registry()))
+
+
+def default_handlers(handlers=[], **handler_names):
+    # Ahead of the other providers, so none of their patterns can shadow it
+    return [(r"/metrics", MetricsHandler, {})] + handlers
+
+
+def uri_rewrites(rewrites=[]):
+    return rewrites
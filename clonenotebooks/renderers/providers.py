@@ -0,0 +1,113 @@
+from collections import namedtuple
+from functools import lru_cache
+import os
+import re
+from urllib.parse import quote, unquote
+
+from tornado.escape import url_unescape
+
+from nbviewer.utils import url_path_join
+
+# What the cloner needs to know about a notebook: its URL without the protocol,
+# the protocol, and the kernel name and directory (URL without protocol) to use
+# for a "global" kernelspec, if there can be one
+CloneSource = namedtuple(
+    "CloneSource", ["url", "protocol", "kernel_name", "kernelspec_source"]
+)
+
+
+class RepositoryURLs:
+    """Maps files in one kind of repository to the raw URLs the cloner fetches them from
+
+    raw_url is a template for the raw URL of a file, with {user}, {repo}, {ref}
+    and {path} fields, e.g. GitLab's "https://gitlab.com/{user}/{repo}/-/raw/{ref}/{path}".
+    The repository root, where a "global" kernelspec is looked for, is the same URL
+    with an empty path. The template is parsed once, here.
+    """
+
+    def __init__(self, raw_url):
+        self.protocol, _, template = raw_url.partition("://")
+        self.template = template
+        self.root_template = template.replace("{path}", "").rstrip("/")
+
+    def clone_source(self, user, repo, ref, path):
+        fields = {
+            "user": quote(user, safe=""),
+            "repo": quote(repo, safe=""),
+            "ref": quote(ref, safe="/"),
+        }
+        return CloneSource(
+            url=self.template.format(path=quote(path, safe="/"), **fields),
+            protocol=self.protocol,
+            kernel_name="{}-{}".format(repo, ref),
+            kernelspec_source=self.root_template.format(**fields),
+        )
+
+
+@lru_cache()
+def repository_urls(raw_url):
+    """RepositoryURLs for a raw URL template, made once per template"""
+    return RepositoryURLs(raw_url)
+
+
+def github_raw_url():
+    # Read once at startup; GitHub Enterprise raw urls are formatted differently
+    if os.environ.get("GITHUB_API_URL", "") == "":
+        return "https://raw.githubusercontent.com/{user}/{repo}/{ref}/{path}"
+    github_url = os.environ.get("GITHUB_URL", "") or "https://github.com/"
+    return url_path_join(github_url, "{user}/{repo}/raw/{ref}/{path}")
+
+
+# Raw URL templates by provider. Others, such as self-hosted mirrors, can be added
+# here or, per nbviewer instance, in the "clone_raw_urls" handler setting.
+RAW_URLS = {
+    "github": github_raw_url(),
+    "gitlab": "https://gitlab.com/{user}/{repo}/-/raw/{ref}/{path}",
+}
+
+
+def split_protocol(url):
+    """Split a URL into its protocol and the rest, as the cloner takes them"""
+    protocol, _, rest = url.partition("://")
+    return protocol, rest
+
+
+def url_clone_source(secure, netloc, url):
+    """The CloneSource of a notebook at a /url route
+
+    Built the same way URLHandler.get_notebook_data builds the remote URL.
+    """
+    if "/?" in url:
+        url, query = url.rsplit("/?", 1)
+        url = "{}/{}?{}".format(url_unescape(netloc), quote(url), query)
+    else:
+        url = "{}/{}".format(url_unescape(netloc), quote(url))
+    return CloneSource(
+        url=url, protocol="http" + secure, kernel_name=None, kernelspec_source=None
+    )
+
+
+# nbviewer's routes for the notebooks that are cloned from raw URLs
+GITHUB_BLOB_ROUTE = re.compile(
+    r"^github/(?P<user>[^/]+)/(?P<repo>[^/]+)/blob/(?P<ref>[^/]+)/(?P<path>.+)$"
+)
+URL_ROUTE = re.compile(r"^url(?P<secure>s?)/(?P<netloc>[^/]+)/(?P<url>.*)$")
+
+
+def route_clone_source(route, raw_urls=RAW_URLS):
+    """The CloneSource of the notebook at an nbviewer path such as "github/user/repo/blob/ref/path"
+
+    None if the path isn't a route to a single notebook on GitHub or at a URL.
+    """
+    match = GITHUB_BLOB_ROUTE.match(route)
+    if match:
+        fields = {name: unquote(value) for name, value in match.groupdict().items()}
+        return repository_urls(raw_urls["github"]).clone_source(**fields)
+    match = URL_ROUTE.match(route)
+    if match:
+        return url_clone_source(
+            match.group("secure"),
+            unquote(match.group("netloc")),
+            unquote(match.group("url")),
+        )
+    return None
@@ -1,10 +1,14 @@
+import asyncio
+from functools import partial, wraps
+import json
 import os
-import re
+from urllib.parse import urlencode
 
 from jupyterhub.services.auth import HubAuthenticated
+from tornado import web
 
 from nbviewer.handlers import IndexHandler
-from nbviewer.providers.base import cached
+from nbviewer.providers.base import cached as nbviewer_cached
 from nbviewer.providers.url.handlers import URLHandler
 from nbviewer.providers.github.handlers import (
     GitHubBlobHandler,
@@ -14,13 +18,109 @@ from nbviewer.providers.github.handlers import (
 from nbviewer.providers.local.handlers import LocalFileHandler
 from nbviewer.providers.gist.handlers import GistHandler, UserGistsHandler
 
-from nbviewer.utils import url_path_join
+from nbviewer.utils import response_text, url_path_join
 
-from ..utils import cached_property
+from ..metrics import CLONE_ERRORS, COALESCED_REQUESTS, STAGE_SECONDS
+from ..utils import SingleFlight, cached_property
+from .lazy import defer_content, lazy_body
+from .listings import directory_listings
+from .providers import RAW_URLS, repository_urls, split_protocol, url_clone_source
+from .warmer import is_warmer_request, kernelspec_probes
+
+
+# Concurrent requests for the same page share one render
+render_flights = SingleFlight()
+
+
+def coalesced(method):
+    """Let concurrent requests for the same page share the work of the first one
+
+    Requests for a page that's already being worked on wait for it, up to
+    `coalesce_timeout` seconds (60 by default), and are sent the same page, or the
+    same error. If it doesn't end in a page that can be shared, such as a redirect,
+    or takes too long, they're handled on their own after all. Clone requests and
+    ?flush_cache are never coalesced. Pages are told apart the way nbviewer's cache
+    does, by path, or by path and query for handlers that set _cache_key_attr = "uri".
+
+    Only for the gets that aren't wrapped in cached here, i.e. the GitHub tree and
+    gist ones, as nbviewer's @cached already has concurrent requests wait for the
+    first one and read its page from the cache.
+    """
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if (
+            self.is_clone_request
+            or self.is_clone_all_request
+            or self.get_argument("flush_cache", False)
+        ):
+            return await method(self, *args, **kwargs)
+
+        key = getattr(self.request, getattr(self, "_cache_key_attr", "path"))
+        if key not in render_flights:
+            await render_flights.run(
+                key, partial(self.shared_page, method, *args, **kwargs)
+            )
+            return
+
+        COALESCED_REQUESTS.labels("render").inc()
+        try:
+            page = await render_flights.run(
+                key, None, timeout=getattr(self, "coalesce_timeout", 60)
+            )
+        except asyncio.TimeoutError:
+            self.log.info("Timed out waiting for a concurrent request at %s", key)
+            page = None
+        if page is None:
+            return await method(self, *args, **kwargs)
+        headers, content = page
+        for name, value in headers.items():
+            self.set_header(name, value)
+        self.write(content)
+
+    return wrapper
+
+
+def cached(method):
+    """nbviewer's @cached, except that clone requests never read from the cache
+
+    Pages are cached for everyone, so nothing specific to the user is rendered into them.
+    """
+    cached_method = nbviewer_cached(method)
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if self.is_clone_request or self.is_clone_all_request:
+            return await method(self, *args, **kwargs)
+        return await cached_method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class CloneRendererMixin(HubAuthenticated):
-    # stale username info is appearing in the render template, disabling for testing
+    # Label for the metrics
+    provider = "url"
+
+    def prepare(self):
+        if is_warmer_request(self):
+            # Rendering into the cache, which is the same for every user
+            return
+        return super().prepare()
+
+    @property
+    def hub_auth(self):
+        """HubAuth, which remembers the Hub's answers for `hub_user_cache_ttl` seconds
+
+        That's 60 by default, and at least 1, as HubAuth keeps them forever with 0.
+        HubAuthenticated.get_current_user already asks it at most once per request.
+        """
+        hub_auth = super().hub_auth
+        ttl = max(getattr(self, "hub_user_cache_ttl", 60), 1)
+        if hub_auth.cache_max_age != ttl:
+            hub_auth.cache_max_age = ttl
+            hub_auth.cache.max_age = hub_auth.cache.purge_interval = ttl
+        return hub_auth
+
     @property
     def username(self):
         current_user = self.get_current_user()
@@ -35,6 +135,29 @@ class CloneRendererMixin(HubAuthenticated):
         self.log.info("clone_to: %s", clone_to)
         return clone_to
 
+    @property
+    def is_clone_request(self):
+        """Whether this request is a click on one of the "Clone" buttons
+
+        Checked before fetching anything, so that a clone only costs whatever is needed
+        to work out where the single-user server should fetch the notebook from.
+        """
+        return getattr(self, "clone_notebooks", False) and bool(
+            self.get_query_arguments("clone")
+        )
+
+    @property
+    def is_clone_all_request(self):
+        """Whether this request is a click on one of the "Clone all" buttons"""
+        return getattr(self, "clone_notebooks", False) and bool(
+            self.get_query_arguments("clone_all")
+        )
+
+    def repository_urls(self, provider):
+        """The RepositoryURLs for a provider, from the "clone_raw_urls" setting if it's there"""
+        raw_url = getattr(self, "clone_raw_urls", {}).get(provider, RAW_URLS[provider])
+        return repository_urls(raw_url)
+
     def clone_to_user_server(
         self,
         url,
@@ -43,14 +166,130 @@ class CloneRendererMixin(HubAuthenticated):
         kernel_name=None,
         kernelspec_source=None,
     ):
-        redirect_endpoint = "/user-redirect/{}_clone?clone_from={}&clone_to={}&protocol={}".format(
-            provider_type, url, self.clone_to, protocol
+        self.redirect_to_cloner(
+            "{}_clone".format(provider_type),
+            [
+                ("clone_from", url),
+                ("clone_to", self.clone_to),
+                ("protocol", protocol),
+                ("kernel_name", kernel_name or None),
+                ("kernelspec_source", kernelspec_source or None),
+                # Known if the cache warmer has already looked
+                ("kernelspec_probes", kernelspec_probes(url)),
+            ],
+        )
+
+    def bulk_clone_to_user_server(
+        self,
+        urls,
+        provider_type,
+        protocol="https",
+        kernel_name=None,
+        kernelspec_source=None,
+        directory_name=None,
+        clone_from_dir=None,
+    ):
+        """Redirect to the single-user server's bulk cloner, to clone all of urls at once
+
+        For local files, clone_from_dir can be given instead of urls to clone
+        every notebook in a directory.
+        """
+        arguments = [("clone_from", url) for url in urls]
+        arguments += [
+            ("clone_from_dir", clone_from_dir),
+            ("clone_to", self.clone_to),
+            ("protocol", protocol),
+            ("kernel_name", kernel_name),
+            ("kernelspec_source", kernelspec_source),
+            ("directory_name", directory_name),
+        ]
+        self.redirect_to_cloner("{}_bulk_clone".format(provider_type), arguments)
+
+    def clone_options(self):
+        """The options for how to clone, such as ?strip_outputs or ?sync, to pass on to the cloner"""
+        options = []
+        if self.get_query_arguments("strip_outputs"):
+            options.append(("strip_outputs", "1"))
+        sync = self.get_query_argument("sync", None)
+        if sync is not None:
+            options.append(("sync", sync or "1"))
+        max_output_bytes = self.get_query_argument("max_output_bytes", "")
+        if max_output_bytes:
+            options.append(("max_output_bytes", max_output_bytes))
+        return options
+
+    def redirect_to_cloner(self, endpoint, arguments):
+        """Redirect to a cloner on the user's server, leaving out arguments that are None
+
+        All the query arguments are escaped here, so URLs with their own query strings,
+        ports or escapes, and directories with spaces, arrive at the cloner intact.
+        Unless the "clone_jobs" setting is False, the cloner is asked to clone in the
+        background, and answers with a page that follows the clone's progress.
+        """
+        arguments = list(arguments) + self.clone_options()
+        if getattr(self, "clone_jobs", True):
+            arguments.append(("job", "1"))
+        query = urlencode(
+            [(name, value) for name, value in arguments if value is not None]
+        )
+        self.observe_redirect()
+        self.redirect("/user-redirect/{}?{}".format(endpoint, query))
+
+    def observe_redirect(self):
+        # Everything nbviewer does for a clone, including asking the Hub who the user is
+        STAGE_SECONDS.labels("redirect", self.provider).observe(
+            self.request.request_time()
+        )
+
+    def on_finish(self):
+        if self.get_status() >= 400 and (
+            self.is_clone_request or self.is_clone_all_request
+        ):
+            CLONE_ERRORS.labels(self.provider, self.get_status()).inc()
+        super().on_finish()
+
+    async def shared_page(self, method, *args, **kwargs):
+        """Call method, and return the page it renders as (headers, content) for coalesced requests
+
+        That's a page passed to cache_and_finish, which is the same for every user.
+        Returns None for anything else, e.g. a redirect, a download, an
+        error, or a page that was already cached.
+        """
+        self._shared_page = None
+        try:
+            await method(self, *args, **kwargs)
+            return self._shared_page
+        finally:
+            del self._shared_page
+
+    async def cache_and_finish(self, content=""):
+        # The page's lazily loaded parts are in the cache before it's sent
+        writes, self.lazy_cache_writes = getattr(self, "lazy_cache_writes", []), []
+        for result in await asyncio.gather(*writes, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.log.warning(
+                    "Failed to cache part of %s: %s", self.request.path, result
+                )
+        await super().cache_and_finish(content)
+        if hasattr(self, "_shared_page") and self.get_status() == 200:
+            self._shared_page = self.cache_headers, content
+
+    def lazy_notebook_body(self, body):
+        """The notebook's HTML, with parts of large notebooks loaded lazily if "lazy_render_cells" is set
+
+        See clonenotebooks.renderers.lazy.
+        """
+        cells_per_section = getattr(self, "lazy_render_cells", 0)
+        if cells_per_section <= 0:
+            return body
+        # Awaited by cache_and_finish
+        self.lazy_cache_writes = []
+        return lazy_body(
+            body,
+            cells_per_section,
+            getattr(self, "lazy_output_bytes", 256 * 1024),
+            partial(defer_content, self, self.lazy_cache_writes),
         )
-        if kernel_name:
-            redirect_endpoint += "&kernel_name={}".format(kernel_name)
-        if kernelspec_source:
-            redirect_endpoint += "&kernelspec_source={}".format(kernelspec_source)
-        self.redirect(redirect_endpoint)
 
     # Here `self` will come from BaseHandler in nbviewer.providers.base (from which the other NBViewer handlers inherit)
     # Contains values to be unpacked into Jinja2 namespace for renderers to render the custom templates in this package
@@ -59,8 +298,11 @@ class CloneRendererMixin(HubAuthenticated):
         return {
             "clone_notebooks": getattr(self, "clone_notebooks", False),
             "hub_base_url": self.hub_base_url,
+            # For the "Clone without large outputs" buttons, 0 to leave them out
+            "clone_max_output_bytes": getattr(
+                self, "clone_max_output_bytes", 1024 * 1024
+            ),
             "url_path_join": url_path_join,
-            "username": self.username,
         }
 
 
@@ -79,7 +321,7 @@ class URLRenderingHandler(CloneRendererMixin, URLHandler):
     ):
 
         return super().render_notebook_template(
-            body,
+            self.lazy_notebook_body(body),
             nb,
             download_url,
             json_notebook,
@@ -87,37 +329,49 @@ class URLRenderingHandler(CloneRendererMixin, URLHandler):
             **namespace
         )
 
-    # @cached
+    @cached
     async def get(self, secure, netloc, url):
+        # The route already contains everything the cloner needs,
+        # so don't fetch robots.txt or the notebook for a clone
+        if self.is_clone_request:
+            source = url_clone_source(secure, netloc, url)
+            self.clone_to_user_server(
+                url=source.url, protocol=source.protocol, provider_type="url"
+            )
+            return
 
         remote_url, public = await super().get_notebook_data(secure, netloc, url)
 
-        if getattr(self, "clone_notebooks", False):
-            is_clone = self.get_query_arguments("clone")
-            if is_clone:
-                destination = netloc + "/" + url
-                self.clone_to_user_server(
-                    url=destination, protocol="http" + secure, provider_type="url"
-                )
-                return
-
         await super().deliver_notebook(remote_url, public)
 
 
-class GitHubBlobRenderingHandler(CloneRendererMixin, GitHubBlobHandler):
+class GitHubCloneMixin:
+    def github_clone_source(self, user, repo, ref, path):
+        """The CloneSource of a file on GitHub
+
+        It only depends on the route, so it's built the same way
+        GitHubBlobHandler.get_notebook_data builds the raw URL.
+        """
+        return self.repository_urls("github").clone_source(user, repo, ref, path)
+
+
+class GitHubBlobRenderingHandler(
+    GitHubCloneMixin, CloneRendererMixin, GitHubBlobHandler
+):
     """handler for files on github
     If it's a...
     - notebook, render it
     - non-notebook file, serve file unmodified
     - directory, redirect to tree
     """
+    provider = "github"
 
     def render_notebook_template(
         self, body, nb, download_url, json_notebook, **namespace
     ):
 
         return super().render_notebook_template(
-            body,
+            self.lazy_notebook_body(body),
             nb,
             download_url,
             json_notebook,
@@ -125,48 +379,71 @@ class GitHubBlobRenderingHandler(CloneRendererMixin, GitHubBlobHandler):
             **namespace
         )
 
-    # @cached
+    def clone_github_blob(self, user, repo, ref, path):
+        """Redirect a clone of a GitHub notebook without asking the GitHub API about it"""
+        source = self.github_clone_source(user, repo, ref, path)
+        self.clone_to_user_server(
+            url=source.url,
+            provider_type="url",
+            protocol=source.protocol,
+            kernel_name=source.kernel_name,
+            kernelspec_source=source.kernelspec_source,
+        )
+
+    @cached
     async def get(self, user, repo, ref, path):
+        if path.endswith(".ipynb") and self.is_clone_request:
+            self.clone_github_blob(user, repo, ref, path)
+            return
+
         raw_url, blob_url, tree_entry = await super().get_notebook_data(
             user, repo, ref, path
         )
 
-        if path.endswith(".ipynb") and getattr(self, "clone_notebooks", False):
-            is_clone = self.get_query_arguments("clone")
-            if is_clone:
-                truncated_url = re.match(
-                    r"^https?://(?P<truncated_url>.*)", raw_url
-                ).group("truncated_url")
-
-                if (
-                    os.environ.get("GITHUB_API_URL", "") == ""
-                ):  # Default is no GitHub Enterprise
-                    repo_root_url = re.match(
-                        r"^https?://(?P<repo_root_url>[^\/]+/[^\/]+/[^\/]+/[^\/]+)/.*",
-                        raw_url,
-                    ).group("repo_root_url")
-                else:  # GitHub Enterprise raw urls formatted differently
-                    repo_root_url = re.match(
-                        r"^https?://(?P<repo_root_url>[^\/]+/[^\/]+/[^\/]+/raw/[^\/]+)/.*",
-                        raw_url,
-                    ).group("repo_root_url")
-
-                kernel_name = "{}-{}".format(repo, ref)
-                self.clone_to_user_server(
-                    url=truncated_url,
-                    provider_type="url",
-                    protocol="https",
-                    kernel_name=kernel_name,
-                    kernelspec_source=repo_root_url,
-                )
-                return
-
         await super().deliver_notebook(
             user, repo, ref, path, raw_url, blob_url, tree_entry
         )
 
 
-class GitHubTreeRenderingHandler(CloneRendererMixin, GitHubTreeHandler):
+class GitHubTreeRenderingHandler(
+    GitHubCloneMixin, CloneRendererMixin, GitHubTreeHandler
+):
+    provider = "github"
+
+    async def clone_github_tree(self, user, repo, ref, path):
+        """Redirect a clone of every notebook in a GitHub directory, which takes one API request"""
+        with self.catch_client_error():
+            response = await self.github_client.get_contents(user, repo, path, ref=ref)
+        contents = json.loads(response_text(response))
+        if not isinstance(contents, list):
+            raise web.HTTPError(400, "Not a directory: %s" % path)
+
+        sources = [
+            self.github_clone_source(user, repo, ref, entry["path"])
+            for entry in contents
+            if entry["type"] == "file" and entry["name"].endswith(".ipynb")
+        ]
+        if not sources:
+            raise web.HTTPError(404, "No notebooks in %s" % path)
+
+        self.bulk_clone_to_user_server(
+            [source.url for source in sources],
+            provider_type="url",
+            protocol=sources[0].protocol,
+            kernel_name=sources[0].kernel_name,
+            kernelspec_source=sources[0].kernelspec_source,
+            directory_name=os.path.basename(path) or repo,
+        )
+
+    # GitHubTreeHandler.get is already cached
+    @coalesced
+    async def get(self, user, repo, ref, path):
+        if self.is_clone_all_request:
+            await self.clone_github_tree(user, repo, ref, path.rstrip("/"))
+            return
+
+        await super().get(user, repo, ref, path)
+
     def render_treelist_template(
         self,
         entries,
@@ -212,12 +489,14 @@ class GitHubUserRenderingHandler(CloneRendererMixin, GitHubUserHandler):
 
 
 class LocalRenderingHandler(CloneRendererMixin, LocalFileHandler):
+    provider = "local"
+
     def render_notebook_template(
         self, body, nb, download_url, json_notebook, **namespace
     ):
 
         return super().render_notebook_template(
-            body,
+            self.lazy_notebook_body(body),
             nb,
             download_url,
             json_notebook,
@@ -232,18 +511,95 @@ class LocalRenderingHandler(CloneRendererMixin, LocalFileHandler):
             entries, breadcrumbs, title, **self.CLONENOTEBOOKS_NAMESPACE, **namespace
         )
 
-    # @cached
+    async def get_notebook_data(self, path):
+        """LocalFileHandler.get_notebook_data, with directories shown by show_directory"""
+        fullpath = os.path.join(self.localfile_path, path)
+        if self.can_show(fullpath) and os.path.isdir(fullpath):
+            html = await self.show_directory(fullpath, path)
+            await self.cache_and_finish(html)
+            return
+
+        return await super().get_notebook_data(path)
+
+    async def show_directory(self, fullpath, path):
+        """Render one page of the directory view of fullpath
+
+        The directory is listed by clonenotebooks.renderers.listings, off the event loop.
+        Pages have `dirview_page_size` entries (500 by default, 0 for all of them),
+        and are chosen with ?page=.
+        """
+        entries = await directory_listings.entries(
+            fullpath,
+            self.can_show,
+            ttl=getattr(self, "dirview_cache_ttl", 60),
+            workers=getattr(self, "dirview_workers", 4),
+        )
+
+        page_size = getattr(self, "dirview_page_size", 500)
+        pages = -(-len(entries) // page_size) if page_size > 0 else 1
+        try:
+            page = int(self.get_argument("page", "1"))
+        except ValueError:
+            raise web.HTTPError(400, "Invalid page: %s" % self.get_argument("page"))
+        if not 1 <= page <= max(pages, 1):
+            raise web.HTTPError(404, "No page %i of %s" % (page, path))
+        if page_size > 0:
+            shown = entries[(page - 1) * page_size : page * page_size]
+        else:
+            shown = entries
+
+        return self.render_dirview_template(
+            entries=[
+                dict(
+                    entry, url=url_path_join(self._localfile_path, path, entry["name"])
+                )
+                for entry in shown
+            ],
+            breadcrumbs=self.breadcrumbs(path),
+            title=url_path_join(path, "/"),
+            page=page,
+            pages=pages,
+            # For the "Clone all" button, whichever page this is
+            notebooks=sum(entry["class"] == "fa fa-book" for entry in entries),
+        )
+
+    @cached
     async def get(self, path):
-        fullpath = await super().get_notebook_data(path)
+        if self.is_clone_all_request:
+            fullpath = os.path.join(self.localfile_path, path)
+            if not self.can_show(fullpath):
+                self.log.info(
+                    "Path: '%s' is not visible from within nbviewer", fullpath
+                )
+                raise web.HTTPError(404)
+            if os.path.isdir(fullpath):
+                # The cloner lists the directory itself, so only its path is passed along
+                self.bulk_clone_to_user_server(
+                    [],
+                    provider_type="local",
+                    protocol="",
+                    directory_name=os.path.basename(os.path.normpath(fullpath)),
+                    clone_from_dir=fullpath,
+                )
+                return
 
-        if getattr(self, "clone_notebooks", False):
-            is_clone = self.get_query_arguments("clone")
-            if is_clone:
+        if self.is_clone_request:
+            # Same visibility check as LocalFileHandler.get_notebook_data,
+            # but without listing directories or reading the notebook
+            fullpath = os.path.join(self.localfile_path, path)
+            if not self.can_show(fullpath):
+                self.log.info(
+                    "Path: '%s' is not visible from within nbviewer", fullpath
+                )
+                raise web.HTTPError(404)
+            if os.path.isfile(fullpath) and fullpath.endswith(".ipynb"):
                 self.clone_to_user_server(
                     url=fullpath, provider_type="local", protocol=""
                 )
                 return
 
+        fullpath = await super().get_notebook_data(path)
+
         # get_notebook_data returns None if a directory is to be shown or a notebook is to be downloaded,
         # i.e. if no notebook is supposed to be rendered, making deliver_notebook inappropriate
         if fullpath:
@@ -251,12 +607,14 @@ class LocalRenderingHandler(CloneRendererMixin, LocalFileHandler):
 
 
 class GistRenderingHandler(CloneRendererMixin, GistHandler):
+    provider = "gist"
+
     def render_notebook_template(
         self, body, nb, download_url, json_notebook, **namespace
     ):
 
         return super().render_notebook_template(
-            body,
+            self.lazy_notebook_body(body),
             nb,
             download_url,
             json_notebook,
@@ -264,6 +622,55 @@ class GistRenderingHandler(CloneRendererMixin, GistHandler):
             **namespace
         )
 
+    def render_treelist_template(self, **namespace):
+        return super().render_treelist_template(
+            **self.CLONENOTEBOOKS_NAMESPACE, **namespace
+        )
+
+    # GistHandler.get is already cached, so clones are answered before it's called
+    @coalesced
+    async def get(self, user, gist_id, filename=""):
+        if self.is_clone_request or self.is_clone_all_request:
+            if await self.clone_gist(gist_id, filename):
+                return
+        await super().get(user, gist_id, filename)
+
+    async def clone_gist(self, gist_id, filename):
+        """Redirect a clone of the gist to the cloner, or return False if there's none
+
+        e.g. for ?clone on a file that isn't a notebook, which is then rendered. The gist
+        metadata already has the raw URLs, so there's no need to download a truncated
+        file's full content for a clone.
+        """
+        with self.catch_client_error():
+            response = await self.github_client.get_gist(gist_id)
+        gist = json.loads(response_text(response))
+        files = gist["files"]
+        if not filename and len(files) == 1:
+            filename = list(files)[0]
+
+        if self.is_clone_all_request and not filename:
+            urls = [
+                split_protocol(file["raw_url"])[1]
+                for name, file in files.items()
+                if name.endswith(".ipynb")
+            ]
+            if not urls:
+                raise web.HTTPError(404, "No notebooks in gist: %s" % gist_id)
+            self.bulk_clone_to_user_server(
+                urls, provider_type="url", protocol="https", directory_name=gist["id"]
+            )
+            return True
+
+        if self.is_clone_request and filename.endswith(".ipynb"):
+            if filename not in files:
+                raise web.HTTPError(404, "No such file in gist: %s" % filename)
+            protocol, url = split_protocol(files[filename]["raw_url"])
+            self.clone_to_user_server(url=url, provider_type="url", protocol=protocol)
+            return True
+
+        return False
+
     async def file_get(self, user, gist_id, filename, gist, many_files_gist, file):
         content = await super().get_notebook_data(
             gist_id, filename, many_files_gist, file
@@ -272,18 +679,6 @@ class GistRenderingHandler(CloneRendererMixin, GistHandler):
         if not content:
             return
 
-        if getattr(self, "clone_notebooks", False):
-            is_clone = self.get_query_arguments("clone")
-            if is_clone:
-                raw_url = file["raw_url"]
-                truncated_url = re.match(
-                    r"^https?://(?P<truncated_url>.*)", raw_url
-                ).group("truncated_url")
-                self.clone_to_user_server(
-                    url=truncated_url, provider_type="url", protocol="https"
-                )
-                return
-
         await super().deliver_notebook(user, gist_id, filename, gist, file, content)
 
 
@@ -0,0 +1,204 @@
+"""Keeps nbviewer's caches warm for the notebooks everybody opens at the same time
+
+The front page's links, and any other nbviewer paths in the "warm_cache_urls" handler
+setting, are requested from nbviewer itself every "warm_cache_interval" seconds, so they
+are rendered into its cache before users ask for them. For notebooks that can be cloned,
+it is also looked up whether kernel.json files exist next to them and at their repository
+root. Clones pass that on, so single-user servers don't each have to ask.
+"""
+import asyncio
+from hmac import compare_digest
+import ipaddress
+import os
+import posixpath
+import secrets
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from tornado.process import task_id
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from nbviewer.utils import url_path_join
+
+from ..metrics import CACHE_WARMS
+from .providers import RAW_URLS, route_clone_source
+
+# The warmer's requests carry this header, with a secret only known to this process
+# (or to the nbviewer workers it was started with), to skip the Hub login. They're only
+# let in from this machine. The pages it renders are the same for every user anyway.
+WARMER_HEADER = "X-Clonenotebooks-Warmer"
+WARMER_TOKEN = os.environ.get("CLONENOTEBOOKS_WARMER_TOKEN") or secrets.token_hex(16)
+
+# Which kernel.json probes ("global", "local") found something, by notebook URL
+# (without protocol), and until when that's trusted: {url: (probes, expires)}
+kernelspec_hints = {}
+
+
+def kernelspec_probes(url):
+    """The kernelspec probes worth making for a clone of url, comma separated, or None if unknown"""
+    hint = kernelspec_hints.get(url)
+    if hint is None or hint[1] < time.monotonic():
+        return None
+    return hint[0]
+
+
+def is_warmer_request(handler):
+    """Whether handler's request is the warmer's: with its token, over loopback
+
+    The address of the connection's peer is checked rather than remote_ip, which comes
+    from X-Real-Ip or X-Forwarded-For headers when nbviewer is run with xheaders.
+    """
+    if not compare_digest(handler.request.headers.get(WARMER_HEADER, ""), WARMER_TOKEN):
+        return False
+    context = getattr(handler.request.connection, "context", None)
+    address = getattr(context, "address", None)
+    if not isinstance(address, tuple):
+        return False
+    try:
+        ip = ipaddress.ip_address(address[0])
+    except ValueError:
+        return False
+    return (getattr(ip, "ipv4_mapped", None) or ip).is_loopback
+
+
+def frontpage_targets(settings):
+    """The nbviewer paths linked from the front page, as set up from frontpage.json"""
+    setup = settings.get("frontpage_setup")
+    if setup:
+        sections = setup.get("sections", [])
+    else:
+        sections = settings.get("frontpage_sections", [])
+    targets = []
+    for section in sections:
+        for link in section.get("links", []):
+            target = link.get("target", "")
+            # Links can also lead out of nbviewer, e.g. to the Hub
+            if "://" in target or ".." in target.split("/"):
+                continue
+            targets.append(target.lstrip("/"))
+    return targets
+
+
+class CacheWarmer:
+    """Requests targets (nbviewer paths) from the nbviewer at url every interval seconds"""
+
+    def __init__(self, url, targets, interval, workers=4, raw_urls=RAW_URLS):
+        self.url = url
+        self.targets = targets
+        self.interval = interval
+        self.workers = workers
+        self.raw_urls = raw_urls
+        self.client = SimpleAsyncHTTPClient(force_instance=True)
+
+    def start(self):
+        IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await self.warm()
+            elapsed = time.monotonic() - started
+            app_log.info("Warmed %i pages in %.2fs", len(self.targets), elapsed)
+            await asyncio.sleep(max(self.interval - elapsed, 0))
+
+    async def warm(self):
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def warm_target(target):
+            async with semaphore:
+                try:
+                    await self.warm_page(target)
+                except Exception as e:
+                    app_log.warning("Failed to warm %s: %s", target, e)
+                    CACHE_WARMS.labels("page", "error").inc()
+                source = route_clone_source(target, self.raw_urls)
+                if source is None or not source.url.endswith(".ipynb"):
+                    return
+                try:
+                    await self.resolve_kernelspecs(source)
+                except Exception as e:
+                    app_log.warning("Failed to find kernelspecs for %s: %s", target, e)
+                    CACHE_WARMS.labels("kernelspec", "error").inc()
+                    kernelspec_hints.pop(source.url, None)
+
+        await asyncio.gather(*(warm_target(target) for target in self.targets))
+
+    async def warm_page(self, target):
+        # A cache hit if it's still cached, otherwise rendered and cached again
+        response = await self.client.fetch(
+            url_path_join(self.url, target),
+            headers={WARMER_HEADER: WARMER_TOKEN},
+            follow_redirects=False,
+            raise_error=False,
+            request_timeout=300,
+            streaming_callback=lambda chunk: None,
+        )
+        if response.code >= 400:
+            app_log.warning("Failed to warm %s: %s", target, response.code)
+            CACHE_WARMS.labels("page", "error").inc()
+        else:
+            CACHE_WARMS.labels("page", "ok").inc()
+
+    async def resolve_kernelspecs(self, source):
+        """Look for the kernel.json files a clone of source would, and remember which exist"""
+        locations = {"local": posixpath.dirname(source.url)}
+        if source.kernelspec_source:
+            locations["global"] = source.kernelspec_source
+        found = []
+        for probe, dirname in locations.items():
+            response = await self.client.fetch(
+                "{}://{}/kernel.json".format(source.protocol, dirname),
+                raise_error=False,
+                request_timeout=10,
+            )
+            if response.code == 200:
+                found.append(probe)
+            elif response.code != 404:
+                raise response.error
+        CACHE_WARMS.labels("kernelspec", "ok").inc()
+        kernelspec_hints[source.url] = (
+            ",".join(sorted(found)),
+            time.monotonic() + 2 * self.interval,
+        )
+
+
+def start_warmer(settings, handler_settings, host, port):
+    """Start the cache warmer, if "warm_cache_interval" is set in handler_settings
+
+    Called as nbviewer starts, with its tornado settings and the host and port it listens
+    on. Pages are requested over loopback, the only way the warmer's requests are let in.
+    With several nbviewer workers, only the first one warms the (shared) cache.
+    """
+    if task_id() not in (None, 0):
+        return None
+    interval = handler_settings.get("warm_cache_interval", 0)
+    targets = list(handler_settings.get("warm_cache_urls", []))
+    if handler_settings.get("warm_cache_frontpage", True):
+        targets += frontpage_targets(settings)
+    if interval <= 0 or not targets:
+        return None
+
+    if host in ("", "0.0.0.0"):
+        host = "127.0.0.1"
+    elif host == "::":
+        host = "::1"
+    try:
+        loopback = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = host == "localhost"
+    if not loopback:
+        app_log.warning("Not warming the cache, as nbviewer doesn't listen on loopback")
+        return None
+    if ":" in host:
+        host = "[%s]" % host
+    warmer = CacheWarmer(
+        url=url_path_join("http://{}:{}".format(host, port), settings["base_url"]),
+        targets=targets,
+        interval=interval,
+        workers=handler_settings.get("warm_cache_workers", 4),
+        raw_urls=dict(RAW_URLS, **handler_settings.get("clone_raw_urls", {})),
+    )
+    app_log.info("Warming %i pages every %is", len(targets), interval)
+    warmer.start()
+    return warmer
@@ -1,3 +1,8 @@
+import asyncio
+from functools import partial
+import os
+import stat
+
 try:  # Python 3.8
     from functools import cached_property
 except ImportError:
@@ -46,3 +51,68 @@ except ImportError:
         """mimic requests.text property, but for plain HTTPResponse"""
         encoding = encoding or get_encoding_from_headers(response.headers) or "utf-8"
         return response.body.decode(encoding, "replace")
+
+
+class SingleFlight:
+    """Shares one call's result between concurrent callers asking for the same key
+
+    The first caller for a key (the leader) runs the work. Callers asking for the
+    same key before it's done (followers) wait for the leader's result, or error,
+    instead of doing the work again.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    async def run(self, key, func, timeout=None):
+        """Return the result of func() for key, or of the call already in flight for key
+
+        Raises whatever func raises. Followers give up with asyncio.TimeoutError after
+        timeout seconds, in which case the work carries on for anyone else waiting for it.
+        """
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(func())
+            pending.add_done_callback(partial(self._done, key))
+            # Shielded so the leader giving up doesn't cancel the work for the others
+            return await asyncio.shield(pending)
+        return await asyncio.wait_for(asyncio.shield(pending), timeout)
+
+    def _done(self, key, future):
+        if self._pending.get(key) is future:
+            del self._pending[key]
+        if not future.cancelled():
+            # Retrieved, so an error nobody waited for isn't logged as never retrieved
+            future.exception()
+
+
+def check_private(directory):
+    """Raise PermissionError unless only this user (or root) can change what's in directory
+
+    directory has to be owned by this user and not writable by its group or others.
+    Its parents have to be owned by this user or root, and not writable by their group
+    or others either, unless they have the sticky bit, as /tmp does.
+    """
+    uid = os.getuid()
+    path = os.path.abspath(directory)
+    st = os.stat(path)
+    if st.st_uid != uid or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(
+            "%s has to be owned by uid %d and not writable by its group or others"
+            % (path, uid)
+        )
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+        st = os.stat(path)
+        writable = st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        if st.st_uid not in (uid, 0) or (writable and not st.st_mode & stat.S_ISVTX):
+            raise PermissionError(
+                "%s can be changed by other users, so the cache in %s isn't private"
+                % (path, directory)
+            )
@@ -0,0 +1,210 @@
+"""Runs nbviewer with the clonenotebooks renderers as several worker processes
+
+    clonenotebooks-nbviewer [nbviewer's options]
+
+takes the same options and nbviewer_config.py as `python -m nbviewer`, and forks
+NBViewerWorkers.workers copies of nbviewer (one per CPU by default) that all listen on
+its port with SO_REUSEPORT, so the kernel spreads connections between them. Renders of
+large notebooks then only hold up the worker they're on, instead of everyone else's
+pages. Workers that die are started again. The first one also runs the cache warmer,
+if "warm_cache_interval" is set.
+
+The workers share nbviewer's cache through files in NBViewerWorkers.shared_cache_dir,
+or through memcached if nbviewer is set up for it (MEMCACHE_SERVERS) instead. One or the
+other is needed for more than one worker, as the lazily loaded parts of a notebook can
+be asked for from any of them. Their Prometheus metrics are kept in
+NBViewerWorkers.metrics_dir, and added up by clonenotebooks.renderers.metrics.
+
+Set these in nbviewer_config.py, e.g. `c.NBViewerWorkers.workers = 4`, or on the command
+line, e.g. `--NBViewerWorkers.workers=4`.
+"""
+from functools import partial
+import glob
+import os
+import secrets
+import sys
+from tempfile import gettempdir
+
+from tornado import process
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+from tornado.netutil import bind_sockets
+from traitlets import Integer, Unicode
+from traitlets.config import Config, Configurable
+from traitlets.config.loader import KVArgParseConfigLoader, PyFileConfigLoader
+
+from .utils import check_private
+
+# Where nbviewer looks for its config
+CONFIG_FILE = "nbviewer_config.py"
+
+# Where nbviewer looks for memcached servers
+MEMCACHE_VARIABLES = ("MEMCACHIER_SERVERS", "MEMCACHE_SERVERS", "NBCACHE_PORT")
+
+
+class NBViewerWorkers(Configurable):
+    """Settings for running nbviewer as several processes with clonenotebooks-nbviewer"""
+
+    workers = Integer(
+        0,
+        help="""Number of nbviewer processes, 0 for one per CPU, 1 to not fork at all.
+
+        More than one needs shared_cache_dir, or nbviewer's cache in memcached.
+        """,
+    ).tag(config=True)
+
+    max_restarts = Integer(
+        100, help="How many times in all workers that die are started again."
+    ).tag(config=True)
+
+    shared_cache_dir = Unicode(
+        "",
+        help="""Directory of the caches shared by the workers.
+
+        nbviewer's cache of rendered pages, and the lazily loaded parts of notebooks,
+        are kept in its render/ subdirectory.
+        Empty to use nbviewer's own cache, which is only shared if it's memcached,
+        and refused along with more than one worker otherwise. Only nbviewer's user
+        may be able to write to it, as cached pages are unpickled.
+        """,
+    ).tag(config=True)
+
+    shared_cache_max_bytes = Integer(
+        1024 * 1024 * 1024, help="Maximum size in bytes of the shared render cache."
+    ).tag(config=True)
+
+    metrics_dir = Unicode(
+        "",
+        help="""Directory the workers keep their Prometheus metrics in, emptied on startup.
+
+        By default, PROMETHEUS_MULTIPROC_DIR if that's set, otherwise a directory in /tmp.
+        """,
+    ).tag(config=True)
+
+
+def load_settings(argv):
+    """NBViewerWorkers from nbviewer_config.py and argv, and the rest of argv for nbviewer
+
+    Read before forking, without nbviewer, which has to be started in each worker.
+    """
+    config = Config()
+    if os.path.isfile(CONFIG_FILE):
+        config.merge(PyFileConfigLoader(CONFIG_FILE, path=os.getcwd()).load_config())
+    ours = [arg for arg in argv if arg.startswith("--NBViewerWorkers.")]
+    config.merge(KVArgParseConfigLoader(ours).load_config())
+    rest = [arg for arg in argv if arg not in ours]
+    return NBViewerWorkers(config=config), rest
+
+
+def prepare_metrics(settings):
+    """Point prometheus_client at the workers' metrics directory, before it's imported"""
+    directory = (
+        settings.metrics_dir
+        or os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+        or os.path.join(gettempdir(), "clonenotebooks-metrics-%d" % os.getpid())
+    )
+    os.makedirs(directory, exist_ok=True)
+    # Left over from an earlier run
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+
+
+def run_worker(settings, argv):
+    """Start nbviewer with argv in this process, listening on its port along with the other workers"""
+    # Imported once prometheus_client can see PROMETHEUS_MULTIPROC_DIR
+    from nbviewer.app import NBViewer
+
+    from .renderers.cache import FileCache
+    from .renderers.warmer import start_warmer
+    from .utils import cached_property
+
+    class WorkerNBViewer(NBViewer):
+        @cached_property
+        def cache(self):
+            if not settings.shared_cache_dir or getattr(self, "no_cache", False):
+                return super().cache
+            directory = os.path.join(settings.shared_cache_dir, "render")
+            self.log.info("Using the shared cache in %s", directory)
+            return FileCache(directory, max_bytes=settings.shared_cache_max_bytes)
+
+    # nbviewer reads its options from sys.argv
+    sys.argv = sys.argv[:1] + argv
+    nbviewer = WorkerNBViewer()
+    app = nbviewer.tornado_application
+
+    ssl_options = None
+    if getattr(nbviewer, "sslcert", None):
+        ssl_options = {"certfile": nbviewer.sslcert, "keyfile": nbviewer.sslkey}
+    http_server = HTTPServer(app, xheaders=True, ssl_options=ssl_options)
+    http_server.add_sockets(
+        bind_sockets(
+            nbviewer.port, nbviewer.host, reuse_port=process.task_id() is not None
+        )
+    )
+    app_log.info(
+        "Worker %s listening on %s:%i, path %s",
+        process.task_id(),
+        nbviewer.host,
+        nbviewer.port,
+        app.settings["base_url"],
+    )
+    IOLoop.current().add_callback(
+        start_warmer,
+        app.settings,
+        getattr(nbviewer, "handler_settings", {}),
+        nbviewer.host,
+        nbviewer.port,
+    )
+    if process.task_id() is not None:
+        PeriodicCallback(partial(exit_with_parent, os.getppid()), 1000).start()
+    IOLoop.current().start()
+
+
+def exit_with_parent(parent):
+    """Stop the worker once its parent is gone, as the parent doesn't pass signals on"""
+    if os.getppid() != parent:
+        app_log.info("Worker %s exiting along with its parent", process.task_id())
+        IOLoop.current().stop()
+
+
+def check_shared_cache(settings):
+    """Exit with an error if the workers wouldn't share a cache, or a private one"""
+    if settings.shared_cache_dir:
+        directory = os.path.join(settings.shared_cache_dir, "render")
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            check_private(directory)
+        except OSError as e:
+            sys.exit("clonenotebooks-nbviewer: %s" % e)
+        return
+    if settings.workers == 1:
+        return
+    if any(os.environ.get(name) for name in MEMCACHE_VARIABLES):
+        return
+    sys.exit(
+        "clonenotebooks-nbviewer: more than one worker needs a shared cache, "
+        "set NBViewerWorkers.shared_cache_dir, or MEMCACHE_SERVERS for memcached, "
+        "or NBViewerWorkers.workers = 1"
+    )
+
+
+def main(argv=None):
+    settings, argv = load_settings(sys.argv[1:] if argv is None else argv)
+    check_shared_cache(settings)
+    # So that the cache warmer's requests are let in by whichever worker they reach
+    os.environ.setdefault("CLONENOTEBOOKS_WARMER_TOKEN", secrets.token_hex(16))
+
+    if settings.workers == 1:
+        run_worker(settings, argv)
+        return
+
+    prepare_metrics(settings)
+    # Returns in each of the workers, the parent waits for them and restarts those that die
+    process.fork_processes(settings.workers, max_restarts=settings.max_restarts)
+    run_worker(settings, argv)
+
+
+if __name__ == "__main__":
+    main()
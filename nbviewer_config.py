@@ -6,3 +6,12 @@ c.NBViewer.github_blob_handler = "clonenotebooks.renderers.GitHubBlobRenderingHa
 c.NBViewer.github_tree_handler = "clonenotebooks.renderers.GitHubTreeRenderingHandler"
 c.NBViewer.gist_handler = "clonenotebooks.renderers.GistRenderingHandler"
 c.NBViewer.user_gists_handler = "clonenotebooks.renderers.UserGistsRenderingHandler"
+
+# Serve the renderers' Prometheus metrics on /metrics,
+# and the lazily loaded parts of notebooks when lazy_render_cells is set
+from nbviewer.providers import default_providers
+
+c.NBViewer.providers = default_providers + [
+    "clonenotebooks.renderers.metrics",
+    "clonenotebooks.renderers.lazy",
+]
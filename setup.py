@@ -31,7 +31,11 @@ setup(
         "nbformat",
         "tornado",
         "jupyter_client",
+        "prometheus_client",
     ],
+    entry_points={
+        "console_scripts": ["clonenotebooks-nbviewer = clonenotebooks.workers:main"]
+    },
     include_package_data=True,
     data_files=[
         ("etc/jupyter/jupyter_notebook_config.d", [
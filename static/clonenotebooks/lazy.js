@@ -0,0 +1,70 @@
+// Loads the sections of large notebooks that clonenotebooks.renderers.lazy left out of the page,
+// as they're about to be scrolled into view
+(function() {
+  function insert(placeholder, html) {
+    // A fragment made this way runs the outputs' scripts when it's inserted
+    var fragment = document.createRange().createContextualFragment(html);
+    var added = Array.prototype.filter.call(fragment.childNodes, function(node) {
+      return node.nodeType === Node.ELEMENT_NODE;
+    });
+    placeholder.parentNode.replaceChild(fragment, placeholder);
+    if (window.MathJax) {
+      added.forEach(function(element) {
+        MathJax.Hub.Queue(["Typeset", MathJax.Hub, element]);
+      });
+    }
+    added.forEach(watch);
+  }
+
+  function load(placeholder, retries) {
+    if (placeholder.dataset.loading) {
+      return;
+    }
+    placeholder.dataset.loading = "true";
+    fetch(placeholder.dataset.src, {credentials: "same-origin"})
+      .then(function(response) {
+        if (!response.ok) {
+          throw new Error(response.status + " " + response.statusText);
+        }
+        return response.text();
+      })
+      .then(function(html) {
+        insert(placeholder, html);
+      })
+      .catch(function(error) {
+        delete placeholder.dataset.loading;
+        if (retries > 0) {
+          // e.g. a dropped connection, or a worker that was restarted
+          setTimeout(function() { load(placeholder, retries - 1); }, 1000);
+        } else {
+          placeholder.innerHTML = 'Failed to load the rest of this notebook (' + error.message +
+            '), <a href="?flush_cache=true">reload it</a>';
+        }
+      });
+  }
+
+  var observer = window.IntersectionObserver && new IntersectionObserver(function(entries) {
+    entries.forEach(function(entry) {
+      if (entry.isIntersecting) {
+        observer.unobserve(entry.target);
+        load(entry.target, 2);
+      }
+    });
+  }, {rootMargin: "2000px 0px"});
+
+  function watch(element) {
+    var placeholders = element.classList.contains("clonenotebooks-lazy")
+      ? [element] : element.querySelectorAll(".clonenotebooks-lazy");
+    Array.prototype.forEach.call(placeholders, function(placeholder) {
+      if (observer) {
+        observer.observe(placeholder);
+      } else {
+        load(placeholder, 2);
+      }
+    });
+  }
+
+  document.addEventListener("DOMContentLoaded", function() {
+    watch(document.body);
+  });
+}());